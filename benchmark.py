@@ -0,0 +1,224 @@
+from __future__ import print_function, absolute_import
+
+import argparse
+import contextlib
+import copy
+import json
+import time
+from collections import OrderedDict
+
+import torch
+
+import src.networks as nets
+import src.models as models
+import datasets as datasets
+from options import Options
+from src.models.SLBR import Losses
+from train import build_train_loader, train_loader_args
+
+
+def time_forward(net, x, iters, warmup):
+    """Average wall time (seconds) of one inference forward."""
+    with torch.no_grad():
+        for _ in range(warmup):
+            net(x)
+        start = time.time()
+        for _ in range(iters):
+            net(x)
+    return (time.time() - start) / iters
+
+
+def build_variant(base, channels_last, compiled):
+    net = copy.deepcopy(base).eval()
+    net.set_channels_last(channels_last)
+    if compiled:
+        net.compile()
+    return net
+
+
+def bench_forward(args):
+    """Compare eager, channels_last and torch.compile forwards of the network on CPU."""
+    if args.bench_threads > 0:
+        torch.set_num_threads(args.bench_threads)
+    base = nets.__dict__[args.nets](args=args).eval()
+    variants = [
+        ('eager', False, False),
+        ('channels_last', True, False),
+        ('compiled', False, True),
+        ('compiled_channels_last', True, True),
+    ]
+    report = {'input_size': args.input_size, 'threads': torch.get_num_threads(), 'results': []}
+    for batch in [int(b) for b in args.bench_batches.split(',')]:
+        x = torch.rand(batch, 3, args.input_size, args.input_size)
+        with torch.no_grad():
+            reference = base(x)[0][0]
+        eager_time = None
+        for name, channels_last, compiled in variants:
+            net = build_variant(base, channels_last, compiled)
+            seconds = time_forward(net, x, args.bench_iters, args.bench_warmup)
+            with torch.no_grad():
+                max_diff = (net(x)[0][0] - reference).abs().max().item()
+            eager_time = seconds if name == 'eager' else eager_time
+            row = {'batch': batch, 'mode': name, 'latency_s': seconds,
+                   'images_per_s': batch / seconds, 'speedup': eager_time / seconds, 'max_abs_diff': max_diff}
+            report['results'].append(row)
+            print('batch %2d | %-22s | %.4fs | %7.2f img/s | x%.2f | diff %.2e' % (
+                batch, name, seconds, row['images_per_s'], row['speedup'], max_diff))
+    return report
+
+
+class PerPredictionTarget(torch.nn.Module):
+    """The previous behaviour: every prediction runs VGG on the target again."""
+    def __init__(self, vgg_loss):
+        super(PerPredictionTarget, self).__init__()
+        self.vgg_loss = vgg_loss
+
+    def target_features(self, y, Xmask=None):
+        return None
+
+    def forward(self, x, y, Xmask=None, target=None):
+        return self.vgg_loss(x, y, Xmask)
+
+
+def time_train_step(net, losses, batch, iters, warmup):
+    """Average wall time (seconds) of forward + Losses + backward on one batch."""
+    inputs, target, mask = batch
+    net.train()
+    for i in range(warmup + iters):
+        if i == warmup:
+            start = time.time()
+        outputs = net(inputs)
+        coarse_loss, refine_loss, style_loss, mask_loss = losses(inputs, outputs[0], target, outputs[1], mask)
+        total_loss = coarse_loss + refine_loss + mask_loss + style_loss
+        net.zero_grad()
+        total_loss.backward()
+    return (time.time() - start) / iters
+
+
+def bench_losses(args):
+    """Training step time with the target VGG features cached once per batch vs recomputed per prediction."""
+    if args.bench_threads > 0:
+        torch.set_num_threads(args.bench_threads)
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    args.lambda_content = args.lambda_content if args.lambda_content > 0 else 0.25
+    args.lambda_style = args.lambda_style if args.lambda_style > 0 else 0.25
+    identity = lambda x: x
+    net = nets.__dict__[args.nets](args=args).to(device)
+
+    # the timings do not depend on the VGG weights, --bench_pretrained needs the torchvision download
+    losses = Losses(args, device, identity, identity, pretrained=args.bench_pretrained)
+    recompute = Losses(args, device, identity, identity, pretrained=False)
+    recompute.vgg_loss = PerPredictionTarget(losses.vgg_loss)
+
+    report = {'input_size': args.input_size, 'device': str(device), 'results': []}
+    for batch_size in [int(b) for b in args.bench_batches.split(',')]:
+        batch = (torch.rand(batch_size, 3, args.input_size, args.input_size, device=device),
+                 torch.rand(batch_size, 3, args.input_size, args.input_size, device=device),
+                 (torch.rand(batch_size, 1, args.input_size, args.input_size, device=device) > 0.7).float())
+        before = time_train_step(net, recompute, batch, args.bench_iters, args.bench_warmup)
+        after = time_train_step(net, losses, batch, args.bench_iters, args.bench_warmup)
+        row = {'batch': batch_size, 'recompute_target_s': before, 'cached_target_s': after,
+               'saved_s': before - after, 'saved_pct': 100 * (before - after) / before}
+        report['results'].append(row)
+        print('batch %2d | recompute target %.4fs | cached target %.4fs | saved %.4fs (%.1f%%)' % (
+            batch_size, before, after, row['saved_s'], row['saved_pct']))
+    return report
+
+
+class PhaseTimer(object):
+    """Wall time per named phase. The device is synchronized at both ends of a phase so
+    asynchronous CUDA work is charged to the phase that launched it."""
+    def __init__(self, device):
+        self.device = device
+        self.totals = OrderedDict()
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        self.sync()
+        start = time.perf_counter()
+        yield
+        self.sync()
+        self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+
+    def reset(self):
+        self.totals = OrderedDict()
+
+
+def bench_train(args):
+    """Throughput of the real training step (SLBR.train_step, with --accum_steps, --ema, --teacher,
+    --feat_cache and --hard_mining as given) and where its time goes: data wait, host-to-device
+    copy and batch augmentation, forward, the loss terms, backward and the optimizer steps."""
+    if args.bench_threads > 0:
+        torch.set_num_threads(args.bench_threads)
+    args.seed = 1
+    torch.manual_seed(args.seed)
+    dataset_func = datasets.get_dataset(args)
+    args.world_size, args.rank, args.distributed = 1, 0, False
+    train_loader, _ = build_train_loader(dataset_func, train_loader_args(args))
+
+    machine = models.__dict__[args.models](datasets=(train_loader, None), args=args)
+    timer = PhaseTimer(machine.device)
+    machine.timer = machine.loss.timer = timer
+    machine.loss.per_sample = hasattr(machine.train_loader.sampler, 'update')
+    machine.model.train()
+    accum = max(1, args.accum_steps)
+
+    # --feat_cache replaces the machine's loader
+    batches_iter = iter(machine.train_loader)
+    samples = 0
+    for step in range(args.bench_warmup + args.bench_iters):
+        if step == args.bench_warmup:
+            timer.reset()
+            timer.sync()
+            samples, start = 0, time.perf_counter()
+        with timer('data'):
+            try:
+                batches = next(batches_iter)
+            except StopIteration:
+                batches_iter = iter(machine.train_loader)
+                batches = next(batches_iter)
+        inputs, _, _, outputs, _ = machine.train_step(batches, accum, first=step % accum == 0,
+                                                      last=step % accum == accum - 1)
+        samples += inputs.size(0)
+        del outputs
+    timer.sync()
+    wall = time.perf_counter() - start
+    machine.clean()
+
+    order = ['data', 'to_device', 'forward', 'loss', 'loss_pixel', 'loss_vgg', 'loss_mask', 'backward', 'optimizer']
+    phases = OrderedDict((name, timer.totals[name] / args.bench_iters) for name in order if name in timer.totals)
+    step_time = wall / args.bench_iters
+    report = {
+        'dataset': args.dataset, 'dataset_dir': args.dataset_dir, 'workers': args.workers,
+        'batch': args.train_batch, 'preprocess': args.preprocess, 'batch_aug': args.batch_aug,
+        'amp': args.amp, 'accum_steps': accum, 'device': str(machine.device), 'iters': args.bench_iters,
+        'samples_per_s': samples / wall, 'step_s': step_time,
+        'phases_s': phases,
+        # loss_* are parts of loss; optimizer runs once every accum_steps micro-batches
+        'phases_pct': OrderedDict((name, 100 * seconds / step_time) for name, seconds in phases.items()),
+    }
+    print('%.2f samples/s, %.4fs per micro-batch' % (report['samples_per_s'], step_time))
+    for name, seconds in phases.items():
+        print('  %-12s %.4fs  %5.1f%%' % (name if not name.startswith('loss_') else '  ' + name, seconds, report['phases_pct'][name]))
+    return report
+
+
+if __name__ == '__main__':
+    parser = Options().init(argparse.ArgumentParser(description='WaterMark Removal Benchmark'))
+    parser.add_argument('bench', choices=['forward', 'losses', 'train'], help='what to benchmark')
+    parser.add_argument('--bench_batches', default='1,4,8', type=str, help='comma separated batch sizes')
+    parser.add_argument('--bench_iters', default=10, type=int, help='timed iterations per setting')
+    parser.add_argument('--bench_warmup', default=3, type=int, help='untimed iterations per setting (includes compilation)')
+    parser.add_argument('--bench_threads', default=0, type=int, help='CPU threads, 0 keeps the torch default')
+    parser.add_argument('--bench_out', default='', type=str, help='write the report as json to this path')
+    parser.add_argument('--bench_pretrained', action='store_true', help='load the pretrained VGG16 for the losses benchmark')
+    args = parser.parse_args()
+
+    report = {'forward': bench_forward, 'losses': bench_losses, 'train': bench_train}[args.bench](args)
+    if args.bench_out != '':
+        with open(args.bench_out, 'w') as f:
+            json.dump(report, f, indent=2)
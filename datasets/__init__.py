@@ -2,11 +2,24 @@
 # from .BIH import BIH
 from .clwd_dataset import CLWDDataset
 from .lvw_dataset import LVWDataset
+from .packed_dataset import PackedDataset
+from .synth_dataset import SynthDataset
+from .feature_cache_dataset import FeatureCacheDataset
 import importlib
 import torch.utils.data
 from datasets.base_dataset import BaseDataset
 
-__all__ = ('CLWDDataset', 'LVWDataset')
+__all__ = ('CLWDDataset', 'LVWDataset', 'PackedDataset', 'SynthDataset', 'FeatureCacheDataset', 'get_dataset')
+
+DATASETS = {'clwd': CLWDDataset, 'lvw': LVWDataset, 'packed': PackedDataset, 'synth': SynthDataset}
+
+
+def get_dataset(args):
+    """The dataset class of --dataset (lower-cased in args), called as cls(split, args)."""
+    args.dataset = args.dataset.lower()
+    if args.dataset not in DATASETS:
+        raise ValueError("Not known dataset:\t{}".format(args.dataset))
+    return DATASETS[args.dataset]
 
 
 
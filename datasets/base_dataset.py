@@ -2,8 +2,14 @@
 
 It also includes common transformation functions (e.g., get_transform, __scale_width), which can be later used in subclasses.
 """
+import hashlib
+import os
+import os.path as osp
 import random
+import math
 import numpy as np
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 #from PIL import Image
 import cv2
@@ -95,25 +101,263 @@ def get_params(opt, size):
     return {'crop_pos': (x, y), 'flip': flip}
 
 
-def get_transform(opt, params=None, grayscale=False, convert=True, additional_targets=None):
+# area fraction and aspect ratio range of the random training crop (per sample or batched)
+CROP_SCALE = (0.9, 1.0)
+CROP_RATIO = (3. / 4., 4. / 3.)
+
+
+def get_transform(opt, params=None, grayscale=False, convert=True, additional_targets=None, batch_aug=False):
+    # batch_aug: only resize, see get_batch_transform
     transform_list = []
     if grayscale:
         transform_list.append(transforms.ToGray())
     if opt.preprocess == 'resize_and_crop':
-        if params is None:
-            transform_list.append(RandomResizedCrop(opt.crop_size, opt.crop_size, scale=(0.9, 1.0))) # 0.5,1.0
+        if batch_aug:
+            size = batch_work_size(opt)
+            transform_list.append(transforms.Resize(size, size))
+        elif params is None:
+            transform_list.append(MaskAwareRandomResizedCrop(opt.crop_size, opt.crop_size, scale=CROP_SCALE, ratio=CROP_RATIO)) # 0.5,1.0
     elif opt.preprocess == 'resize':
         transform_list.append(transforms.Resize(opt.input_size, opt.input_size))
     elif opt.preprocess == 'none':
         return HCompose(transform_list)
 
     if not opt.no_flip:
-        if params is None:
+        if params is None and not batch_aug:
             # print("flip")
             transform_list.append(HorizontalFlip())
 
     return HCompose(transform_list, additional_targets=additional_targets)
 
+
+class MaskAwareRandomResizedCrop(RandomResizedCrop):
+    """RandomResizedCrop that can be told to keep the watermark in view.
+
+    Call it with crop_region=(bbox, area) from compute_mask_stats (or None for a plain
+    RandomResizedCrop). The crop size is drawn as usual. When the crop can hold the whole
+    bbox, the offset is drawn among the positions that contain it; otherwise among the
+    positions whose resized crop keeps more than min_area mask pixels (window sums from an
+    integral image, checked on the resized mask). If a few draws find none, e.g. for a
+    scattered watermark that no crop of this size covers enough of, the crop goes to the
+    fullest window, which may still hold fewer than min_area pixels. Masks that are too
+    small for min_area even in the whole image are cropped unrestricted.
+    """
+    def __init__(self, height, width, min_area=100, **kwargs):
+        super(MaskAwareRandomResizedCrop, self).__init__(height, width, **kwargs)
+        self.min_area = min_area
+
+    @property
+    def targets_as_params(self):
+        return ['image', 'mask', 'crop_region']
+
+    def get_params_dependent_on_targets(self, params):
+        crop = super(MaskAwareRandomResizedCrop, self).get_params_dependent_on_targets(params)
+        if params['crop_region'] is None:
+            return crop
+        (y0, x0, y1, x1), area = params['crop_region']
+        rows, cols = params['image'].shape[:2]
+        # the smallest resize factor is the one of the whole image
+        if area * self.height * self.width <= self.min_area * rows * cols:
+            return crop
+        h, w = crop['crop_height'], crop['crop_width']
+        if y1 - y0 <= h and x1 - x0 <= w:
+            i = self.sample_start(y0, y1, h, rows)
+            j = self.sample_start(x0, x1, w, cols)
+        else:
+            i, j = self.sample_window(params['mask'], h, w)
+        crop['h_start'] = i * 1.0 / (rows - h + 1e-10)
+        crop['w_start'] = j * 1.0 / (cols - w + 1e-10)
+        return crop
+
+    @staticmethod
+    def sample_start(lo, hi, size, total):
+        # start of a crop covering [lo, hi)
+        return random.randint(max(hi - size, 0), min(lo, total - size))
+
+    def sample_window(self, mask, h, w, tries=10):
+        """Start (i, j) of a random h x w window of mask whose resized crop keeps more than min_area
+        mask pixels, of the fullest window if none of the tries does."""
+        integral = np.pad(mask.astype(np.float64), ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        sums = integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+        # the mask is resized with nearest neighbour: the scaled window sum is only an estimate,
+        # the drawn windows are checked exactly
+        starts = np.argwhere(sums * self.height * self.width > self.min_area * h * w)
+        for k in np.random.permutation(len(starts))[:tries]:
+            i, j = starts[k]
+            crop = cv2.resize(mask[i:i + h, j:j + w], (self.width, self.height), interpolation=cv2.INTER_NEAREST)
+            if crop.sum() > self.min_area:
+                return int(i), int(j)
+        i, j = np.unravel_index(sums.argmax(), sums.shape)
+        return int(i), int(j)
+
+    def get_transform_init_args_names(self):
+        return super(MaskAwareRandomResizedCrop, self).get_transform_init_args_names() + ('min_area',)
+
+
+def compute_mask_stats(masks):
+    """Bounding box (y0, x0, y1, x1) and area (sum) of the watermark pixels of every mask."""
+    bboxes, areas = [], []
+    for mask in masks:
+        ys, xs = np.nonzero(mask > 0)
+        if len(ys) == 0:
+            bboxes.append((0, 0, mask.shape[0], mask.shape[1]))
+        else:
+            bboxes.append((ys.min(), xs.min(), ys.max() + 1, xs.max() + 1))
+        areas.append(float(mask.sum()))
+    return np.array(bboxes, dtype=np.int64).reshape(-1, 4), np.array(areas, dtype=np.float64)
+
+
+def load_mask_stats(path, key):
+    """(bbox, area) stored by save_mask_stats under key, None if missing or stale."""
+    if not osp.exists(path):
+        return None
+    with np.load(path) as stats:
+        if str(stats['key']) != key:
+            return None
+        return stats['bbox'], stats['area']
+
+
+def save_mask_stats(path, key, bbox, area):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, key=np.array(key), bbox=bbox, area=area)
+        os.replace(tmp, path)
+    except OSError as e:
+        # read-only dataset: computed again next time
+        print('==> could not cache the mask statistics in %s: %s' % (path, e))
+
+
+class MaskStatsMixin(object):
+    """Per-sample watermark bbox and area (mask_bbox, mask_area) for the datasets that keep
+    the watermark in their training crops. load_mask (cv2, channel 0 of mask_path % id by
+    default) is also what get_sample reads, so the statistics match the training masks.
+
+    The statistics are computed once and cached in mask_stats.npz in the split folder,
+    keyed by mask_stats_key (the mask files, their sizes and modification times).
+    """
+    def load_mask(self, index):
+        mask = cv2.imread(self.mask_path%self.ids[index])
+        return mask[:, :, 0].astype(np.float32) / 255.
+
+    def mask_stats_key(self):
+        digest = hashlib.sha1()
+        for img_id in self.ids:
+            st = os.stat(self.mask_path%img_id)
+            digest.update(('%s:%d:%d\n' % (img_id, st.st_size, st.st_mtime_ns)).encode())
+        return digest.hexdigest()
+
+    def build_mask_stats(self):
+        """Watermark bbox and area of every sample, used to place the training crops."""
+        self.mask_bbox, self.mask_area = None, None
+        if self.keep_background_prob < 0.0:
+            return
+        path, key = osp.join(self.root, 'mask_stats.npz'), self.mask_stats_key()
+        stats = load_mask_stats(path, key)
+        if stats is None:
+            print('==> Computing the mask statistics of %d samples' % len(self.ids))
+            stats = compute_mask_stats(self.load_mask(i) for i in range(len(self.ids)))
+            save_mask_stats(path, key, *stats)
+        self.mask_bbox, self.mask_area = stats
+
+
+def get_batch_transform(opt):
+    """The batched counterpart of the random part of get_transform, None if there is nothing random.
+
+    With --batch_aug the training datasets keep it as their batch_transform: the workers only
+    resize every sample to one size (batch_work_size) and SLBR.train crops and flips the
+    collated batch on the device.
+    """
+    crop = opt.preprocess == 'resize_and_crop'
+    flip = opt.preprocess != 'none' and not opt.no_flip
+    if not (crop or flip):
+        return None
+    return BatchAugment(opt.crop_size, crop=crop, flip=flip)
+
+
+def batch_work_size(opt):
+    """Size the workers resize to for BatchAugment: its smallest crop box still spans crop_size
+    pixels, so the batched crop is never upsampled (as the per-sample crop of the full image)."""
+    return int(math.ceil(opt.crop_size / math.sqrt(CROP_SCALE[0] / CROP_RATIO[1])))
+
+
+class BatchAugment(object):
+    """RandomResizedCrop + HorizontalFlip for a whole batch of aligned tensors.
+
+    One affine grid per sample (crop box and mirror) and a single grid_sample call per
+    tensor: bilinear for images, nearest for masks, as albumentations does. Samples flagged
+    in keep (the datasets' keep-background draw) get their box placed on the watermark of
+    the first mask, like MaskAwareRandomResizedCrop.
+    """
+    def __init__(self, size, scale=CROP_SCALE, ratio=CROP_RATIO, crop=True, flip=True, min_area=100):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.crop = crop
+        self.flip = flip
+        self.min_area = min_area
+
+    def place_on_mask(self, mask, keep, w, h, cx, cy, steps=33):
+        """Box centres for the samples flagged in keep, drawn among a steps x steps grid of the
+        positions whose box keeps more than min_area mask pixels at the output size (window
+        sums of an integral image scaled by the resize, an estimate that discounts the box
+        border), or at the fullest position if none does. Samples whose
+        whole mask stays below min_area keep their random centre.
+        """
+        b, _, rows, cols = mask.shape
+        m = (mask[:, 0] > 0.5).float()
+        flat = F.pad(m.cumsum(1).cumsum(2), (1, 0, 1, 0)).reshape(b, -1)
+        t = torch.linspace(-1, 1, steps, device=mask.device)
+        gx, gy = t[None] * (1 - w)[:, None], t[None] * (1 - h)[:, None]
+        # box edges in pixels of the (b, steps) candidate centres
+        edge = lambda c, half, n: ((c + half[:, None] + 1) / 2 * n).round().long().clamp(0, n)
+        x0, x1, y0, y1 = edge(gx, -w, cols), edge(gx, w, cols), edge(gy, -h, rows), edge(gy, h, rows)
+        corner = lambda y, x: flat.gather(1, (y[:, :, None] * (cols + 1) + x[:, None, :]).reshape(b, -1))
+        window = lambda y0, y1, x0, x1: corner(y1, x1) - corner(y0, x1) - corner(y1, x0) + corner(y0, x0)
+        sums = window(y0, y1, x0, x1)
+        # counted one pixel inside the box: nearest sampling can miss its border rows and columns
+        inner = window((y0 + 1).clamp(max=rows), (y1 - 1).clamp(min=0), (x0 + 1).clamp(max=cols), (x1 - 1).clamp(min=0))
+        valid = inner * (self.size ** 2 / (w * cols * h * rows))[:, None] > self.min_area
+        fullest = sums == sums.max(1, keepdim=True)[0]
+        k = torch.multinomial(torch.where(valid.any(1, keepdim=True), valid, fullest).float(), 1)
+        placed_x, placed_y = gx.gather(1, k % steps)[:, 0], gy.gather(1, k // steps)[:, 0]
+        place = keep.bool() & (m.sum((1, 2)) * self.size ** 2 > self.min_area * rows * cols)
+        return torch.where(place, placed_x, cx), torch.where(place, placed_y, cy)
+
+    def sample_theta(self, b, device, mask=None, keep=None):
+        theta = torch.zeros(b, 2, 3, device=device)
+        if self.crop:
+            # box area / image area and aspect ratio as RandomResizedCrop, the box is clipped
+            # to the image instead of being re-drawn
+            area = torch.empty(b, device=device).uniform_(*self.scale)
+            log_ratio = torch.empty(b, device=device).uniform_(math.log(self.ratio[0]), math.log(self.ratio[1]))
+            w = torch.sqrt(area * torch.exp(log_ratio)).clamp(max=1)
+            h = torch.sqrt(area / torch.exp(log_ratio)).clamp(max=1)
+            cx = (torch.rand(b, device=device) * 2 - 1) * (1 - w)
+            cy = (torch.rand(b, device=device) * 2 - 1) * (1 - h)
+            if keep is not None:
+                cx, cy = self.place_on_mask(mask, keep, w, h, cx, cy)
+        else:
+            w = h = torch.ones(b, device=device)
+            cx = cy = torch.zeros(b, device=device)
+        if self.flip:
+            w = torch.where(torch.rand(b, device=device) < 0.5, -w, w)
+        theta[:, 0, 0], theta[:, 0, 2] = w, cx
+        theta[:, 1, 1], theta[:, 1, 2] = h, cy
+        return theta
+
+    def warp(self, x, grid, mode):
+        dtype = x.dtype
+        out = F.grid_sample(x.float(), grid, mode=mode, padding_mode='border', align_corners=False)
+        return out.to(dtype)
+
+    def __call__(self, images, masks=(), keep=None):
+        b = images[0].shape[0]
+        size = self.size if self.crop else images[0].shape[-1]
+        theta = self.sample_theta(b, images[0].device, masks[0] if keep is not None else None, keep)
+        grid = F.affine_grid(theta, (b, 1, size, size), align_corners=False)
+        return [self.warp(x, grid, 'bilinear') for x in images], [self.warp(m, grid, 'nearest') for m in masks]
+
 def __make_power_2(img, base):
     ow, oh = img.size
     h = int(round(oh / base) * base)
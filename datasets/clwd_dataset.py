@@ -6,10 +6,10 @@ import os
 import sys
 import torch
 from torchvision import datasets, transforms
-from .base_dataset import get_transform
+from .base_dataset import get_transform, get_batch_transform, MaskStatsMixin
 import random
 
-class CLWDDataset(torch.utils.data.Dataset):
+class CLWDDataset(MaskStatsMixin, torch.utils.data.Dataset):
     def __init__(self, is_train, args):
         
         args.is_train = is_train == 'train'
@@ -33,7 +33,9 @@ class CLWDDataset(torch.utils.data.Dataset):
             #     (0.5,0.5,0.5),
             #     (0.5,0.5,0.5)
             # )])
-        self.augment_transform = get_transform(args, 
+        batch_aug = args.batch_aug and args.is_train
+        self.batch_transform = get_batch_transform(args) if batch_aug else None
+        self.augment_transform = get_transform(args, batch_aug=batch_aug, 
             additional_targets={'J':'image', 'I':'image', 'watermark':'image', 'mask':'mask', 'alpha':'mask' }) #,
         self.transform_tensor = transforms.ToTensor()
 
@@ -47,6 +49,7 @@ class CLWDDataset(torch.utils.data.Dataset):
         self.ids = list()
         for file in os.listdir(self.root+'/Watermarked_image'):
             self.ids.append(file.strip('.jpg'))
+        self.build_mask_stats()
         cv2.setNumThreads(0)
         cv2.ocl.setUseOpenCL(False)
         
@@ -68,10 +71,9 @@ class CLWDDataset(torch.utils.data.Dataset):
         if w is None: print(self.W_path%img_id)
         w = cv2.cvtColor(w, cv2.COLOR_BGR2RGB)
 
-        mask = cv2.imread(self.mask_path%img_id)
+        mask = self.load_mask(index)
         alpha = cv2.imread(self.alpha_path%img_id)
         
-        mask = mask[:, :, 0].astype(np.float32) / 255.
         alpha = alpha[:, :, 0].astype(np.float32) / 255.
         
         return {'J': img_J, 'I': img_I, 'watermark': w, 'mask':mask, 'alpha':alpha, 'img_path':self.imageJ_path%img_id}
@@ -80,7 +82,7 @@ class CLWDDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         sample = self.get_sample(index)
         self.check_sample_types(sample)
-        sample = self.augment_sample(sample)
+        sample = self.augment_sample(sample, index)
 
         J = self.transform_norm(sample['J'])
         I = self.transform_norm(sample['I'])
@@ -96,8 +98,12 @@ class CLWDDataset(torch.utils.data.Dataset):
             'wm': w,
             'mask': mask,
             'alpha':alpha,
-            'img_path':sample['img_path']
+            'img_path':sample['img_path'],
+            'idx':index
         }
+        if self.batch_transform is not None:
+            # the batched crop is placed on the watermark too
+            data['keep_wm'] = sample.get('keep_wm', False)
         return data
 
     def check_sample_types(self, sample):
@@ -105,28 +111,23 @@ class CLWDDataset(torch.utils.data.Dataset):
         assert sample['I'].dtype == 'uint8'
         assert sample['watermark'].dtype == 'uint8'
 
-    def augment_sample(self, sample):
+    def augment_sample(self, sample, index):
         if self.augment_transform is None:
             return sample
         #print(self.transform.additional_targets.keys())
         additional_targets = {target_name: sample[target_name]
                               for target_name in self.augment_transform.additional_targets.keys()}
 
-        valid_augmentation = False
-        while not valid_augmentation:
-            aug_output = self.augment_transform(image=sample['I'], **additional_targets)
-            valid_augmentation = self.check_augmented_sample(sample, aug_output)
+        # keep the watermark in the crop (mask.sum() > 100) unless this sample may show background only
+        crop_region = None
+        if self.keep_background_prob >= 0.0 and random.random() >= self.keep_background_prob:
+            crop_region = (self.mask_bbox[index], self.mask_area[index])
+        sample['keep_wm'] = crop_region is not None
+        aug_output = self.augment_transform(image=sample['I'], crop_region=crop_region, **additional_targets)
+        aug_output.pop('crop_region')
 
         for target_name, transformed_target in aug_output.items():
             #print(target_name,transformed_target.shape)
             sample[target_name] = transformed_target
 
         return sample
-
-    def check_augmented_sample(self, sample, aug_output):
-        if self.keep_background_prob < 0.0 or random.random() < self.keep_background_prob:
-            return True
-        return aug_output['mask'].sum() > 100
-
-
-
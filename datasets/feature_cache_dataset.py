@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+# uint8 image fields of a cached sample; the encoder outputs are float16 ('code', 'skip_<i>')
+IMAGE_FIELDS = [('image', 3), ('target', 3), ('mask', 1)]
+
+
+def cache_key(encoder, args, length):
+    """Identifies a cache: the encoder weights and the (unaugmented) training images it was computed from."""
+    digest = hashlib.sha1()
+    for name, tensor in sorted(encoder.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    digest.update(json.dumps([args.dataset, osp.abspath(args.dataset_dir), args.input_size,
+                              args.gan_norm, length]).encode())
+    return digest.hexdigest()
+
+
+def is_cache_valid(root, key):
+    index_path = osp.join(root, 'index.json')
+    if not osp.exists(index_path):
+        return False
+    with open(index_path) as f:
+        return json.load(f)['key'] == key
+
+
+def to_uint8(x):
+    return (x.float() * 255).round().clamp(0, 255).to(torch.uint8).numpy()
+
+
+def build_feature_cache(net, dataset, root, key, device, batch_size=16, workers=0, norm=lambda x: x):
+    """Run net.encode over every sample of dataset (in eval mode) and write the fields to root.
+
+    index.json is written last, so an interrupted build is never mistaken for a valid cache.
+    """
+    os.makedirs(root, exist_ok=True)
+    if osp.exists(osp.join(root, 'index.json')):
+        os.remove(osp.join(root, 'index.json'))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    n = len(dataset)
+    arrays, paths = None, [''] * n
+    training = net.training
+    net.eval()
+    print('==> caching the encoder outputs of %d samples in %s' % (n, root))
+    with torch.no_grad():
+        for batch in loader:
+            inputs = batch['image'].float().to(device)
+            code, skips = net.encode(norm(inputs).contiguous(memory_format=net.memory_format))
+            fields = {'image': to_uint8(batch['image']), 'target': to_uint8(batch['target']),
+                      'mask': (batch['mask'].float() > 0.5).to(torch.uint8).numpy(),
+                      'code': code.half().cpu().numpy()}
+            for i, skip in enumerate(skips):
+                fields['skip_%d' % i] = skip.half().cpu().numpy()
+            if arrays is None:
+                arrays = {name: np.lib.format.open_memmap(osp.join(root, name + '.npy'), mode='w+',
+                                                          dtype=value.dtype, shape=(n,) + value.shape[1:])
+                          for name, value in fields.items()}
+            idx = batch['idx'].numpy()
+            for name, value in fields.items():
+                arrays[name][idx] = value
+            for i, path in zip(idx, batch['img_path']):
+                paths[i] = path
+    for array in arrays.values():
+        array.flush()
+    net.train(training)
+
+    index = {'key': key, 'length': n, 'n_skips': len(skips), 'paths': paths}
+    with open(osp.join(root, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(osp.join(root, 'index.json.tmp'), osp.join(root, 'index.json'))
+
+
+class FeatureCacheDataset(torch.utils.data.Dataset):
+    """Training samples with the outputs of a frozen CoarseEncoder, written by build_feature_cache.
+
+    Every field is one memory-mapped .npy file; a sample carries its images and mask like
+    CLWDDataset plus 'code' and 'skips' (float16) for SLBR.decode. There is no augmentation:
+    the features only match the images they were computed from.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.batch_transform = None
+        self.arrays = None # opened lazily, once per worker process
+
+    def __len__(self):
+        return self.index['length']
+
+    def open_arrays(self):
+        names = [name for name, _ in IMAGE_FIELDS] + ['code'] + ['skip_%d' % i for i in range(self.index['n_skips'])]
+        self.arrays = {name: np.load(osp.join(self.root, name + '.npy'), mmap_mode='r') for name in names}
+
+    def __getitem__(self, index):
+        if self.arrays is None:
+            self.open_arrays()
+        read = lambda name: torch.from_numpy(np.array(self.arrays[name][index]))
+        return {
+            'image': read('image').float() / 255.,
+            'target': read('target').float() / 255.,
+            'mask': read('mask'),
+            'code': read('code'),
+            'skips': [read('skip_%d' % i) for i in range(self.index['n_skips'])],
+            'img_path': self.index['paths'][index],
+            'idx': index,
+        }
@@ -0,0 +1,92 @@
+import hashlib
+import numpy as np
+import cv2
+import os.path as osp
+import json
+import torch
+from torchvision import transforms
+from .base_dataset import get_transform, get_batch_transform
+from .clwd_dataset import CLWDDataset
+
+# fields of a packed sample: (name, channels) -- mask and alpha keep only their first channel
+PACKED_FIELDS = [('J', 3), ('I', 3), ('watermark', 3), ('mask', 1), ('alpha', 1)]
+
+
+def shard_path(root, field, shard):
+    return osp.join(root, '%s_%05d.npy' % (field, shard))
+
+
+def packed_stats_key(index):
+    """Key of the mask statistics pack_dataset.py stores with the shards (fixed once written)."""
+    return hashlib.sha1(json.dumps([index['ids'], index['paths'], index['shard_size'], index['shapes']]).encode()).hexdigest()
+
+
+class PackedDataset(CLWDDataset):
+    """CLWD/LVW split written by pack_dataset.py.
+
+    Every field lives in fixed-shape uint8 .npy shards that are memory-mapped, so
+    get_sample only slices the pages of one sample instead of decoding five images.
+    Augmentation and the returned batch are the same as for the source dataset.
+    """
+    def __init__(self, is_train, args):
+        args.is_train = is_train == 'train'
+        self.root = osp.join(args.dataset_dir, 'train' if args.is_train else 'test')
+        with open(osp.join(self.root, 'index.json')) as f:
+            self.index = json.load(f)
+        # same split settings as the source dataset class
+        if args.is_train:
+            self.keep_background_prob = 0.01 if self.index['dataset'] == 'lvw' else -1
+        else:
+            self.keep_background_prob = -1
+            if self.index['dataset'] == 'clwd':
+                args.preprocess = 'resize'
+                args.no_flip = True
+
+        self.args = args
+        self.transform_norm = transforms.Compose([transforms.ToTensor()])
+        batch_aug = args.batch_aug and args.is_train
+        self.batch_transform = get_batch_transform(args) if batch_aug else None
+        self.augment_transform = get_transform(args, batch_aug=batch_aug,
+            additional_targets={'J':'image', 'I':'image', 'watermark':'image', 'mask':'mask', 'alpha':'mask' })
+        self.transform_tensor = transforms.ToTensor()
+
+        self.ids = self.index['ids']
+        self.shard_size = self.index['shard_size']
+        self.shards = None
+        self.build_mask_stats()
+        self.shards = None # opened lazily, once per worker process
+        cv2.setNumThreads(0)
+        cv2.ocl.setUseOpenCL(False)
+
+    def open_shards(self):
+        n_shards = (len(self.ids) + self.shard_size - 1) // self.shard_size
+        self.shards = {field: [np.load(shard_path(self.root, field, s), mmap_mode='r') for s in range(n_shards)]
+                       for field, _ in PACKED_FIELDS}
+
+    def mask_stats_key(self):
+        return packed_stats_key(self.index)
+
+    def load_mask(self, index):
+        if self.shards is None:
+            self.open_shards()
+        shard, offset = divmod(index, self.shard_size)
+        return self.shards['mask'][shard][offset].astype(np.float32) / 255.
+
+    def get_sample(self, index):
+        if self.shards is None:
+            self.open_shards()
+        shard, offset = divmod(index, self.shard_size)
+        # zero-copy memmap slices; mask/alpha become float like the decoded ones
+        sample = {field: self.shards[field][shard][offset] for field, _ in PACKED_FIELDS}
+        sample['mask'] = sample['mask'].astype(np.float32) / 255.
+        sample['alpha'] = sample['alpha'].astype(np.float32) / 255.
+        sample['img_path'] = self.index['paths'][index]
+        return sample
+
+    def augment_sample(self, sample, index):
+        sample = super(PackedDataset, self).augment_sample(sample, index)
+        # ToTensor needs writable arrays: copy only the read-only slices no transform has replaced
+        for field in ('J', 'I', 'watermark'):
+            if not sample[field].flags.writeable:
+                sample[field] = np.array(sample[field])
+        return sample
@@ -0,0 +1,134 @@
+import numpy as np
+import cv2
+import os
+import os.path as osp
+import random
+from torchvision import transforms
+from .base_dataset import get_transform, get_batch_transform
+from .clwd_dataset import CLWDDataset
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+FONTS = [cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX,
+         cv2.FONT_HERSHEY_TRIPLEX, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, cv2.FONT_ITALIC | cv2.FONT_HERSHEY_SIMPLEX]
+TEXT_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789@&.'
+
+
+def list_images(root):
+    if not osp.isdir(root):
+        return []
+    return sorted(osp.join(root, f) for f in os.listdir(root) if f.lower().endswith(IMG_EXTENSIONS))
+
+
+def parse_range(spec):
+    low, high = spec.split(',')
+    return float(low), float(high)
+
+
+class SynthDataset(CLWDDataset):
+    """Watermarked samples composited on the fly, J = alpha * W + (1 - alpha) * I as in CLWD.
+
+    dataset_dir/<train|test>/Watermark_free_image holds the clean images (a CLWD root works
+    as is) and the optional dataset_dir/<train|test>/Logo the RGBA logos; with
+    --synth_text_prob or without logos a random text is rendered instead. Scale, opacity,
+    position and colour are drawn per sample: fresh ones for training, fixed per index
+    (seeded) for validation. Augmentation and the returned batch are the same as for CLWD.
+    """
+    def __init__(self, is_train, args):
+        args.is_train = is_train == 'train'
+        self.root = osp.join(args.dataset_dir, 'train' if args.is_train else 'test')
+        self.keep_background_prob = -1
+        if not args.is_train:
+            args.preprocess = 'resize'
+            args.no_flip = True
+
+        self.args = args
+        self.transform_norm = transforms.Compose([transforms.ToTensor()])
+        batch_aug = args.batch_aug and args.is_train
+        self.batch_transform = get_batch_transform(args) if batch_aug else None
+        self.augment_transform = get_transform(args, batch_aug=batch_aug,
+            additional_targets={'J':'image', 'I':'image', 'watermark':'image', 'mask':'mask', 'alpha':'mask' })
+        self.transform_tensor = transforms.ToTensor()
+
+        self.backgrounds = list_images(osp.join(self.root, 'Watermark_free_image'))
+        self.logos = list_images(osp.join(self.root, 'Logo'))
+        if len(self.backgrounds) == 0:
+            raise ValueError('no clean images in %s' % osp.join(self.root, 'Watermark_free_image'))
+        self.text_prob = args.synth_text_prob if len(self.logos) > 0 else 1.0
+        self.scale = parse_range(args.synth_scale)
+        self.opacity = parse_range(args.synth_opacity)
+        length = args.synth_length if args.is_train and args.synth_length > 0 else len(self.backgrounds)
+        self.ids = list(range(length))
+        print('==> synthesising %d %s samples from %d clean images and %d logos' % (
+            length, 'train' if args.is_train else 'val', len(self.backgrounds), len(self.logos)))
+        cv2.setNumThreads(0)
+        cv2.ocl.setUseOpenCL(False)
+
+    def rng(self, index):
+        # validation has to show the same watermarks every time
+        if self.args.is_train:
+            return np.random.default_rng(random.getrandbits(64))
+        return np.random.default_rng(index)
+
+    def read_image(self, path, flags=cv2.IMREAD_COLOR):
+        img = cv2.imread(path, flags)
+        if img is None:
+            raise IOError('cannot read %s' % path)
+        return img
+
+    def render_logo(self, rng, width):
+        """RGB watermark and its [0, 1] alpha, width pixels wide."""
+        if rng.random() < self.text_prob:
+            return self.render_text(rng, width)
+        logo = self.read_image(self.logos[rng.integers(len(self.logos))], cv2.IMREAD_UNCHANGED)
+        if logo.ndim == 2:
+            logo = cv2.cvtColor(logo, cv2.COLOR_GRAY2BGRA)
+        elif logo.shape[2] == 3:
+            # no alpha channel: the logo is opaque where it differs from a white background
+            alpha = (255 - logo.min(axis=2) > 16).astype(np.uint8) * 255
+            logo = np.concatenate([logo, alpha[..., None]], axis=2)
+        height = max(1, int(round(logo.shape[0] * width / logo.shape[1])))
+        logo = cv2.resize(logo, (width, height), interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(np.ascontiguousarray(logo[:, :, :3]), cv2.COLOR_BGR2RGB)
+        return rgb, logo[:, :, 3].astype(np.float32) / 255.
+
+    def render_text(self, rng, width):
+        text = ''.join(rng.choice(list(TEXT_CHARS), size=rng.integers(3, 13)))
+        font = FONTS[rng.integers(len(FONTS))]
+        thickness = int(rng.integers(1, 4))
+        (text_w, text_h), baseline = cv2.getTextSize(text, font, 1.0, thickness)
+        font_scale = width / float(text_w)
+        thickness = max(1, int(round(thickness * font_scale)))
+        (text_w, text_h), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+        canvas = np.zeros((text_h + baseline + 2 * thickness, text_w + 2 * thickness), np.uint8)
+        cv2.putText(canvas, text, (thickness, text_h + thickness), font, font_scale, 255, thickness, cv2.LINE_AA)
+        color = rng.integers(0, 256, size=3).astype(np.uint8)
+        rgb = np.broadcast_to(color, canvas.shape + (3,)).copy()
+        return rgb, canvas.astype(np.float32) / 255.
+
+    def get_sample(self, index):
+        rng = self.rng(index)
+        if len(self.ids) == len(self.backgrounds):
+            path = self.backgrounds[index]
+        else: # --synth_length: any clean image
+            path = self.backgrounds[rng.integers(len(self.backgrounds))]
+        img_I = cv2.cvtColor(self.read_image(path), cv2.COLOR_BGR2RGB)
+        h, w = img_I.shape[:2]
+
+        logo, logo_alpha = self.render_logo(rng, max(8, int(w * rng.uniform(*self.scale))))
+        # logos taller or wider than the image are shrunk to fit
+        fit = min(1.0, 0.95 * h / logo.shape[0], 0.95 * w / logo.shape[1])
+        if fit < 1.0:
+            size = (max(1, int(logo.shape[1] * fit)), max(1, int(logo.shape[0] * fit)))
+            logo, logo_alpha = cv2.resize(logo, size, interpolation=cv2.INTER_AREA), cv2.resize(logo_alpha, size, interpolation=cv2.INTER_AREA)
+        lh, lw = logo_alpha.shape
+        y, x = rng.integers(0, h - lh + 1), rng.integers(0, w - lw + 1)
+
+        alpha = np.zeros((h, w), np.float32)
+        alpha[y:y+lh, x:x+lw] = logo_alpha * rng.uniform(*self.opacity)
+        w_img = np.zeros_like(img_I)
+        w_img[y:y+lh, x:x+lw] = logo
+        img_J = alpha[..., None] * w_img + (1 - alpha[..., None]) * img_I
+        img_J = np.clip(np.round(img_J), 0, 255).astype(np.uint8)
+        mask = (alpha > 0).astype(np.float32)
+
+        return {'J': img_J, 'I': img_I, 'watermark': w_img, 'mask': mask, 'alpha': alpha, 'img_path': path}
@@ -20,6 +20,62 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def state_dict(self):
+        return {'val': self.val, 'sum': self.sum, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.val, self.sum, self.count = state['val'], state['sum'], state['count']
+        self.avg = self.sum / self.count if self.count > 0 else 0
+
+
+class DeviceMeter(AverageMeter):
+    """AverageMeter that accepts tensors and keeps the running sum on their device.
+
+    update() never synchronizes; val/sum/avg are refreshed by sync(), or by sync_meters()
+    for several meters with a single device-to-host copy. The sum is accumulated in float64
+    in the same order as AverageMeter, so the synced numbers equal the per-step .item() ones.
+    """
+    def reset(self):
+        super(DeviceMeter, self).reset()
+        self.running = None # [sum, last value]
+
+    def update(self, val, n=1):
+        if not torch.is_tensor(val):
+            val = torch.tensor(float(val), dtype=torch.float64)
+        val = val.detach().double().reshape(())
+        if self.running is None:
+            self.running = torch.zeros(2, dtype=torch.float64, device=val.device)
+        self.running[0] += val * n
+        self.running[1] = val
+        self.count += n
+
+    def pending(self):
+        return self.running if self.running is not None else torch.zeros(2, dtype=torch.float64)
+
+    def load(self, values):
+        if self.count > 0:
+            self.sum, self.val = values
+            self.avg = self.sum / self.count
+
+    def sync(self):
+        self.load(self.pending().tolist())
+
+    def state_dict(self):
+        self.sync()
+        return super(DeviceMeter, self).state_dict()
+
+    def load_state_dict(self, state, device=None):
+        super(DeviceMeter, self).load_state_dict(state)
+        self.running = torch.tensor([self.sum, self.val], dtype=torch.float64, device=device)
+
+
+def sync_meters(*meters):
+    """Bring several DeviceMeters to host with one transfer."""
+    device = next((m.running.device for m in meters if m.running is not None), torch.device('cpu'))
+    values = torch.stack([m.pending().to(device) for m in meters]).tolist()
+    for meter, value in zip(meters, values):
+        meter.load(value)
+
 
 def normPRED(d, eps=1e-2):
     ma = torch.max(d)
@@ -35,19 +91,21 @@ def normPRED(d, eps=1e-2):
 def compute_fPSNR(pred, gt):
     return 
 
-def compute_RMSE(pred, gt, mask, is_w=False):
+def compute_RMSE(pred, gt, mask, is_w=False, to_host=True):
     if is_w:
         if isinstance(mask, torch.Tensor):
             mse = torch.mean((pred*mask - gt*mask)**2, dim=[1,2,3])
             rmse = mse*np.prod(mask.shape[1:])/(torch.sum(mask, dim=[1,2,3])+1e-6)
-            rmse = torch.sqrt(rmse).mean().item()
+            rmse = torch.sqrt(rmse).mean()
+            rmse = rmse.item() if to_host else rmse
         elif isinstance(mask, np.ndarray):
             rmse = MSE(pred*mask, gt*mask)*np.prod(mask.shape) / (np.sum(mask)+1e-6)
             rmse = np.sqrt(rmse)
     else:
         if isinstance(mask, torch.Tensor):
             mse = torch.mean((pred - gt)**2, dim=[1,2,3])
-            rmse = torch.sqrt(mse).mean().item()
+            rmse = torch.sqrt(mse).mean()
+            rmse = rmse.item() if to_host else rmse
 
         elif isinstance(mask, np.ndarray):
             rmse = MSE(pred, gt)*np.prod(mask.shape) / (np.sum(mask)+1e-6)
@@ -57,18 +115,19 @@ def compute_RMSE(pred, gt, mask, is_w=False):
 
 
 def compute_mAP(outputs, labels):
-    y_true = labels.cpu().detach().view(labels.size(0),-1).numpy()
-    y_pred = outputs.cpu().detach().view(labels.size(0),-1).numpy()
+    y_true = labels.cpu().detach().reshape(labels.size(0),-1).numpy()
+    y_pred = outputs.cpu().detach().reshape(labels.size(0),-1).numpy()
     AP = []
     for i in range(y_true.shape[0]):
         AP.append(average_precision_score(y_true[i],y_pred[i]))
     return np.mean(AP)
 
-def compute_IoU(pred, gt, threshold=0.5, eps=1e-5):
+def compute_IoU(pred, gt, threshold=0.5, eps=1e-5, to_host=True):
     pred = torch.where(pred > threshold, torch.ones_like(pred), torch.zeros_like(pred)).to(pred.device)
     intersection = (pred * gt).sum(dim=[1,2,3])
     union = pred.sum(dim=[1,2,3]) + gt.sum(dim=[1,2,3]) - intersection
-    return (intersection / (union+eps)).mean().item()
+    iou = (intersection / (union+eps)).mean()
+    return iou.item() if to_host else iou
 
 def MAE(pred, gt):
     if isinstance(pred, torch.Tensor):
@@ -0,0 +1,43 @@
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import time
+
+from options import Options
+from src.utils.batch_finder import (CONFIG_PATH, SIZE_STEP, default_size, find_max_batch, find_max_size, machine_key,
+                                    memory_budget, save_result, setting_key)
+
+
+def main(args):
+    """Search the largest batch (or with --find_size the largest input size) and store it for this machine."""
+    budget = memory_budget(args.mem_budget)
+    path = args.batch_config or CONFIG_PATH
+    print('==> %s on %s, budget %.0f MB' % (args.find_mode, machine_key(), budget / 2 ** 20))
+    if args.find_size:
+        batch = args.train_batch if args.find_mode == 'train' else args.test_batch
+        size, peak = find_max_size(args, args.find_mode, batch, budget, args.max_size)
+        if size == 0:
+            raise ValueError('batch %d does not fit in %.0f MB even at %dpx' % (batch, budget / 2 ** 20, SIZE_STEP))
+    else:
+        size = default_size(args, args.find_mode)
+        batch, peak = find_max_batch(args, args.find_mode, size, budget, args.max_batch)
+        if batch == 0:
+            raise ValueError('a single %dpx image does not fit in %.0f MB' % (size, budget / 2 ** 20))
+    result = {'batch': batch, 'size': size, 'peak_mb': round(peak / 2 ** 20, 1),
+              'budget_mb': round(budget / 2 ** 20, 1), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    save_result(setting_key(args, args.find_mode, size), result, path)
+    print('==> largest %s step: batch %d at %dpx (%.0f MB), saved to %s' % (
+        args.find_mode, batch, size, result['peak_mb'], path))
+
+
+if __name__ == '__main__':
+    parser = Options().init(argparse.ArgumentParser(description='WaterMark Removal Batch Finder'))
+    parser.add_argument('--find_mode', default='train', choices=['train', 'infer'], help='a full training step or an inference forward')
+    parser.add_argument('--find_size', action='store_true', help='search the largest input size at --train-batch (--test-batch for infer) instead of the batch')
+    parser.add_argument('--mem_budget', default=0, type=float, help='memory budget in MB (0: 90%% of the GPU, 80%% of the RAM on CPU)')
+    parser.add_argument('--max_batch', default=512, type=int, help='largest batch tried')
+    parser.add_argument('--max_size', default=2048, type=int, help='largest input size tried with --find_size')
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+    main(args)
@@ -113,5 +113,50 @@ class Options():
         parser.add_argument('--use_refine', action='store_true', help='train batchsize') 
         parser.add_argument('--k_refine', default=3, type=int, help='train batchsize')
         parser.add_argument('--k_skip_stage', default=3, type=int, help='train batchsize')
+        parser.add_argument('--start_filters', default=32, type=int, help='filters of the first encoder level (also the refinement width)')
+        parser.add_argument('--grad_ckpt', default='none', type=str, choices=['none', 'block', 'stage'], help='activation checkpointing granularity')
+        parser.add_argument('--channels_last', action='store_true', help='run the network in channels_last (NHWC) memory format')
+        parser.add_argument('--compile', action='store_true', help='capture the network forward with torch.compile')
+        parser.add_argument('--log_freq', default=100, type=int, help='print and log the running metrics every N iterations (the only host syncs of the loops)')
+        parser.add_argument('--res_schedule', default='', type=str, help='progressive resolution, e.g. 0:256,10:384,20:512 (epoch:size); --train-batch is scaled from the --crop_size/--input-size one')
+        parser.add_argument('--synth_length', default=0, type=int, help='--dataset synth: training samples per epoch (0: one per clean image)')
+        parser.add_argument('--synth_scale', default='0.15,0.6', type=str, help='--dataset synth: logo width range, relative to the image width')
+        parser.add_argument('--synth_opacity', default='0.3,0.9', type=str, help='--dataset synth: watermark opacity range')
+        parser.add_argument('--synth_text_prob', default=0.3, type=float, help='--dataset synth: probability of a random text instead of a logo')
+        parser.add_argument('--mask_pyramid', action='store_true', help='compute the loss of every mask map at its own resolution against the area-pooled GT instead of upsampling the maps')
+        parser.add_argument('--feat_cache', default='', type=str, help='fine-tune with a frozen encoder: cache its outputs of the unaugmented training images in this directory and train the rest from them')
+        parser.add_argument('--ema', default=0, type=float, help='keep an exponential moving average of the weights with this decay (e.g. 0.999), validate and save it (0: off)')
+        parser.add_argument('--ema_freq', default=1, type=int, help='--ema: average in the weights every K optimizer steps')
+        parser.add_argument('--auto_batch', action='store_true', help='use the batch find_batch.py stored for this machine and these options (--train-batch for training, the predictor batch)')
+        parser.add_argument('--batch_config', default='', type=str, help='batch config written by find_batch.py (default: ~/.cache/slbr/batch_config.json)')
+        parser.add_argument('--accum_steps', default=1, type=int, help='accumulate the gradients of K batches of --train-batch before every optimizer step')
+        parser.add_argument('--hard_mining', action='store_true', help='draw the training samples in proportion to their last loss instead of a uniform shuffle')
+        parser.add_argument('--hard_temperature', default=1.0, type=float, help='--hard_mining: sampling weight (loss / mean loss) ** (1 / T), larger is closer to uniform')
+        parser.add_argument('--hard_decay', default=0.5, type=float, help='--hard_mining: per epoch, losses not measured again move this factor closer to the mean')
+        parser.add_argument('--ckpt_freq', default=0, type=int, help='also save the full training state to checkpoint.pth.tar every N iterations (0: only with validation)')
+        parser.add_argument('--keep_ckpt', default=0, type=int, help='keep the checkpoints of the last K saves (checkpoint_step_<N>.pth.tar) besides checkpoint.pth.tar and model_best.pth.tar')
+        parser.add_argument('--log_image_freq', default=100, type=int, help='log a preview grid to TensorBoard every N iterations (0: never)')
+        parser.add_argument('--log_image_size', default=128, type=int, help='height of the preview images, larger ones are downsampled')
+        parser.add_argument('--async_eval', action='store_true', help='validate the saved checkpoints in a separate process instead of pausing training')
+        parser.add_argument('--eval_gpu_id', default='', type=str, help='CUDA_VISIBLE_DEVICES of the async evaluator (-1 for CPU), default: same as training')
+        parser.add_argument('--dist_backend', default='', type=str, choices=['', 'nccl', 'gloo'], help='torchrun process group backend (default: nccl with GPUs, gloo otherwise)')
+        parser.add_argument('--amp', default='none', type=str, choices=['none', 'fp16', 'bf16'], help='mixed precision training (bf16 also works on CPU)')
+        parser.add_argument('--batch_aug', action='store_true', help='random crop/flip the collated training batch on the device instead of per sample in the workers')
+        # Knowledge distillation
+        parser.add_argument('--teacher', default='', type=str, metavar='PATH', help='frozen teacher checkpoint, enables distillation')
+        parser.add_argument('--teacher_start_filters', default=32, type=int, help='start_filters of the teacher network')
+        parser.add_argument('--teacher_k_refine', default=3, type=int, help='CFF blocks of the teacher network')
+        parser.add_argument('--lambda_kd', default=1, type=float, help='weight of the teacher image distillation loss')
+        parser.add_argument('--lambda_kd_mask', default=1, type=float, help='weight of the teacher mask distillation loss')
+        parser.add_argument('--lambda_kd_feat', default=0.5, type=float, help='weight of the decoder feature distillation loss')
+        # Detection
+        parser.add_argument('--detect_threshold', default=-1, type=float, help='run the mask-only detector first and skip removal below this watermark probability (negative to disable)')
+        parser.add_argument('--detect_min_area', default=100, type=int, help='minimum mask area (pixels) of a detected watermark region')
+        # Pruning (prune.py)
+        parser.add_argument('--prune_flops', default=0.4, type=float, help='target MACs of the pruned model as a fraction of the original')
+        parser.add_argument('--prune_criterion', default='bn', type=str, choices=['bn', 'l1', 'taylor'], help='channel importance criterion')
+        parser.add_argument('--prune_min_channels', default=4, type=int, help='minimum channels kept per channel group')
+        parser.add_argument('--prune_taylor_batches', default=20, type=int, help='training batches used to accumulate taylor importance')
+        parser.add_argument('--prune_epochs', default=1, type=int, help='fine-tune epochs after pruning')
 
         return parser
\ No newline at end of file
@@ -0,0 +1,105 @@
+from __future__ import print_function, absolute_import
+
+import argparse
+import json
+import os
+import multiprocessing
+
+import cv2
+import numpy as np
+
+import datasets as datasets
+from datasets.base_dataset import compute_mask_stats, save_mask_stats
+from datasets.packed_dataset import PACKED_FIELDS, packed_stats_key, shard_path
+from options import Options
+
+
+_dataset = None
+
+
+def init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def load(job):
+    index, size = job
+    sample = _dataset.get_sample(index)
+    packed = {}
+    for field, channels in PACKED_FIELDS:
+        x = sample[field]
+        if x.dtype != np.uint8:
+            # mask/alpha come back as float in [0,1] from the uint8 files
+            x = np.round(x * 255.).astype(np.uint8)
+        if size > 0 and x.shape[:2] != (size, size):
+            x = cv2.resize(x, (size, size), interpolation=cv2.INTER_LINEAR if channels == 3 else cv2.INTER_NEAREST)
+        packed[field] = x
+    return packed, sample['img_path']
+
+
+def pack_split(dataset_func, split, args):
+    dataset = dataset_func(split, args)
+    out_root = os.path.join(args.out_dir, 'train' if split == 'train' else 'test')
+    os.makedirs(out_root, exist_ok=True)
+
+    init_worker(dataset)
+    first, _ = load((0, args.pack_size))
+    shapes = {field: first[field].shape for field, _ in PACKED_FIELDS}
+    n = len(dataset)
+    paths, bboxes, areas = [], [], []
+    # decoding is the slow part: -j worker processes each hold a copy of the dataset
+    pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(dataset,)) if args.workers > 0 else None
+    jobs = ((i, args.pack_size) for i in range(n))
+    samples = pool.imap(load, jobs, chunksize=16) if pool is not None else map(load, jobs)
+
+    shards = None
+    for i, (packed, path) in enumerate(samples):
+        shard, offset = divmod(i, args.shard_size)
+        if offset == 0:
+            if shards is not None:
+                for mm in shards.values(): mm.flush()
+            count = min(args.shard_size, n - i)
+            shards = {field: np.lib.format.open_memmap(shard_path(out_root, field, shard), mode='w+',
+                                                       dtype=np.uint8, shape=(count,) + shapes[field])
+                      for field, _ in PACKED_FIELDS}
+        for field, _ in PACKED_FIELDS:
+            if packed[field].shape != shapes[field]:
+                raise ValueError("{} has shape {}, expected {}: pass --pack_size to resize".format(
+                    path, packed[field].shape, shapes[field]))
+            shards[field][offset] = packed[field]
+        paths.append(path)
+        # mask statistics of the packed (possibly resized) masks, for the crops at training time
+        bbox, area = compute_mask_stats([packed['mask'].astype(np.float32) / 255.])
+        bboxes.append(bbox)
+        areas.append(area)
+        if (i + 1) % 1000 == 0:
+            print('==> %s: %d/%d' % (split, i + 1, n))
+    for mm in shards.values(): mm.flush()
+    if pool is not None:
+        pool.close()
+
+    index = {'dataset': args.dataset, 'ids': dataset.ids, 'paths': paths, 'shard_size': args.shard_size,
+             'shapes': {field: list(shape) for field, shape in shapes.items()}}
+    save_mask_stats(os.path.join(out_root, 'mask_stats.npz'), packed_stats_key(index),
+                    np.concatenate(bboxes), np.concatenate(areas))
+    with open(os.path.join(out_root, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    print('==> packed %d %s samples into %s' % (n, split, out_root))
+
+
+def main(args):
+    dataset_func = datasets.get_dataset(args)
+    if args.dataset not in ('clwd', 'lvw'):
+        raise ValueError("Only clwd and lvw can be packed, not:\t{}".format(args.dataset))
+    # decode only: the augmentations run at training time on the packed samples
+    for split in ['train', 'val']:
+        pack_split(dataset_func, split, args)
+
+
+if __name__ == '__main__':
+    parser = Options().init(argparse.ArgumentParser(description='WaterMark Removal Dataset Packing'))
+    parser.add_argument('--out_dir', required=True, type=str, help='output folder, use it as --dataset_dir with --dataset packed')
+    parser.add_argument('--shard_size', default=1000, type=int, help='samples per shard file')
+    parser.add_argument('--pack_size', default=0, type=int, help='resize every sample to this size, 0 keeps the original size (must be uniform)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,116 @@
+from __future__ import print_function, absolute_import
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+
+import src.models as models
+import datasets as datasets
+from options import Options
+from src.utils.pruning import count_macs, search_ratio, prune_model, prune_spec
+
+
+def cpu_latency(net, input_size, batch, iters=5):
+    """Average CPU forward time (seconds) of one batch."""
+    net = copy.deepcopy(net).cpu().eval()
+    x = torch.rand(batch, 3, input_size, input_size)
+    with torch.no_grad():
+        net(x)
+        start = time.time()
+        for _ in range(iters):
+            net(x)
+    return (time.time() - start) / iters
+
+
+def measure(machine, args, tag):
+    net = machine.model
+    device = next(net.parameters()).device
+    stats = {
+        'macs_G': count_macs(net, args.input_size, device) / 1e9,
+        'params_M': sum(p.numel() for p in net.parameters()) / 1e6,
+        'cpu_latency_s': cpu_latency(net, args.input_size, args.test_batch),
+    }
+    if machine.val_loader is not None:
+        machine.validate(0)
+        stats['psnr'] = machine.metric
+    print('==> %s: %s' % (tag, stats))
+    return stats
+
+
+def accumulate_taylor_grads(machine, args):
+    # gradients of the training loss over a few batches, consumed by the taylor criterion
+    machine.model.train()
+    machine.model.zero_grad_all()
+    for i, batches in enumerate(machine.train_loader):
+        if i >= args.prune_taylor_batches:
+            break
+        inputs = batches['image'].float().to(machine.device)
+        target = batches['target'].float().to(machine.device)
+        mask = batches['mask'].float().to(machine.device)
+        outputs = machine.model(machine.norm(inputs))
+        coarse_loss, refine_loss, style_loss, mask_loss = machine.loss(
+            inputs, outputs[0], machine.norm(target), outputs[1], mask)
+        total_loss = args.lambda_l1*(coarse_loss+refine_loss) + args.lambda_mask * (mask_loss) + style_loss
+        total_loss.backward()
+
+
+def main(args):
+    args.seed = 1
+    torch.manual_seed(args.seed)
+
+    dataset_func = datasets.get_dataset(args)
+
+    train_loader = torch.utils.data.DataLoader(dataset_func('train',args),batch_size=args.train_batch, shuffle=True,
+        num_workers=args.workers, pin_memory=True)
+    val_loader = torch.utils.data.DataLoader(dataset_func('val',args),batch_size=args.test_batch, shuffle=False,
+        num_workers=args.workers, pin_memory=True)
+
+    machine = models.__dict__[args.models](datasets=(train_loader, val_loader), args=args)
+    report = {'target_macs': args.prune_flops, 'criterion': args.prune_criterion}
+    report['original'] = measure(machine, args, 'original')
+
+    if args.prune_criterion == 'taylor':
+        accumulate_taylor_grads(machine, args)
+
+    ratio, scores = search_ratio(machine.model, args.prune_flops, criterion=args.prune_criterion,
+                                 min_channels=args.prune_min_channels)
+    report['channels'] = prune_model(machine.model, ratio, min_channels=args.prune_min_channels, scores=scores)
+    report['ratio'] = ratio
+    machine.model.zero_grad_all()
+    machine.model.set_optimizers()
+    machine.optimizer = torch.optim.Adam(machine.model.parameters(), lr=args.lr,
+                                         betas=(args.beta1,args.beta2), weight_decay=args.weight_decay)
+    machine.prune_spec = prune_spec(machine.model)
+    machine.train_state = None # fine-tuning starts over, not where the resumed training stopped
+    machine.ema = None # averaged over the unpruned shapes
+    report['pruned'] = measure(machine, args, 'pruned')
+
+    print('============================ Pruning Finish && Fine-tuning Start =============================================')
+    for epoch in range(args.prune_epochs):
+        machine.train(epoch)
+    report['finetuned'] = measure(machine, args, 'fine-tuned')
+    report['speedup'] = report['original']['cpu_latency_s'] / report['finetuned']['cpu_latency_s']
+
+    state = {
+                'epoch': args.prune_epochs,
+                'nets': args.nets,
+                'state_dict': machine.model.state_dict(),
+                'best_acc': machine.metric,
+                'optimizer': None,
+                'prune_spec': machine.prune_spec,
+            }
+    torch.save(state, os.path.join(machine.args.checkpoint, 'pruned.pth.tar'))
+    with open(os.path.join(machine.args.checkpoint, 'prune_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('==> speed-up %.2fx, report saved to %s' % (report['speedup'], machine.args.checkpoint))
+    machine.clean()
+
+
+if __name__ == '__main__':
+    parser=Options().init(argparse.ArgumentParser(description='WaterMark Removal Pruning'))
+    args = parser.parse_args()
+    main(args)
@@ -1,6 +1,7 @@
 import argparse
 import torch
 import os
+import shutil
 import cv2
 import numpy as np
 
@@ -9,6 +10,7 @@ torch.backends.cudnn.benchmark = True
 import datasets as datasets
 import src.models as models
 from options import Options
+from src.utils.batch_finder import lookup_batch, machine_key
 import torch.nn.functional as F
 
 
@@ -82,6 +84,32 @@ def test_dataloder(img_path, crop_size):
 
 
 
+@torch.no_grad()
+def detect_watermark(net, inputs, mask_threshold=0.5, min_area=100):
+    """Run the mask-only detector on a batch.
+
+    Returns one dict per image with the watermark probability (mean of the
+    ``min_area`` most confident mask pixels) and the bounding boxes
+    ``(x0, y0, x1, y1)`` of the connected mask regions, in input pixels.
+    """
+    immask = net.detect(inputs)[0]
+    b = immask.shape[0]
+    flat = immask.reshape(b, -1)
+    k = min(min_area, flat.shape[1])
+    probs = flat.topk(k, dim=1)[0].mean(dim=1).cpu().numpy()
+    masks = (immask[:, 0] > mask_threshold).cpu().numpy().astype(np.uint8)
+
+    detections = []
+    for prob, m in zip(probs, masks):
+        n, _, stats, _ = cv2.connectedComponentsWithStats(m, connectivity=8)
+        boxes = []
+        for x, y, w, h, area in stats[1:n]:
+            if area >= min_area:
+                boxes.append((int(x), int(y), int(x + w), int(y + h)))
+        detections.append({'prob': float(prob), 'boxes': boxes})
+    return detections
+
+
 def slbr_predict_custom(args):
 
     Machine = models.__dict__[args.models](datasets=(None, None), args=args)
@@ -94,12 +122,33 @@ def slbr_predict_custom(args):
     if not os.path.exists(prediction_dir): os.makedirs(prediction_dir)
     
     doc_loader,fns = test_dataloder(args.test_dir, args.crop_size)
+    batch_size = 1
+    if args.auto_batch:
+        batch_size = lookup_batch(args, 'infer', path=args.batch_config)
+        if batch_size is None:
+            raise ValueError('no batch stored for {} and these options, run find_batch.py --find_mode infer first'.format(machine_key()))
+        print("==> --auto_batch: %d images per forward" % batch_size)
     with torch.no_grad():
-        for i, batches in enumerate(zip(doc_loader, fns)):
-            inputs, fn = batches[0], batches[1]
-            print("fn files", fn)
-            
-            inputs = inputs.to(model.device).float()
+        for start in range(0, len(doc_loader), batch_size):
+            inputs = torch.cat(doc_loader[start:start + batch_size]).to(model.device).float()
+            batch_fns = fns[start:start + batch_size]
+            print("fn files", batch_fns)
+
+            if args.detect_threshold >= 0:
+                dets = detect_watermark(model.model, inputs, min_area=args.detect_min_area)
+                keep = []
+                for j, (det, fn) in enumerate(zip(dets, batch_fns)):
+                    print("detect prob %.4f, boxes %s" % (det['prob'], det['boxes']))
+                    if det['prob'] < args.detect_threshold:
+                        # no watermark found, keep the original image
+                        shutil.copyfile(fn, os.path.join(prediction_dir, os.path.split(fn)[-1]))
+                    else:
+                        keep.append(j)
+                if len(keep) == 0:
+                    continue
+                inputs = inputs[keep]
+                batch_fns = [batch_fns[j] for j in keep]
+
             outputs = model.model(inputs)
             imoutput,immask_all,imwatermark = outputs
 
@@ -107,12 +156,13 @@ def slbr_predict_custom(args):
             immask = immask_all[0]
 
             imfinal =imoutput*immask + inputs*(1-immask)
-            save_output(
-                inputs = {'I':inputs},
-                preds = {'bg':imfinal, 'mask':immask},
-                save_dir= prediction_dir,
-                img_fn = fn
-            )
+            for j, fn in enumerate(batch_fns):
+                save_output(
+                    inputs = {'I':inputs[j:j + 1]},
+                    preds = {'bg':imfinal[j:j + 1], 'mask':immask[j:j + 1]},
+                    save_dir= prediction_dir,
+                    img_fn = fn
+                )
             
             
 
@@ -0,0 +1,86 @@
+import os
+import copy
+import shutil
+
+import torch
+import torch.multiprocessing as mp
+
+import src.models as models
+import datasets as datasets
+from src.utils.pruning import apply_prune_spec
+
+
+class AsyncEvaluator(object):
+    """Validate saved checkpoints in a separate process while training continues.
+
+    submit() hands over a snapshot of a checkpoint. The evaluator process runs the
+    machine's validate() on the CLWD/LVW validation split, writes the val/* scalars to the
+    TensorBoard directory of the run and atomically replaces model_best.pth.tar when the
+    snapshot is the best so far. At most max_pending snapshots wait, then submit() blocks.
+
+    Create it before the training machine: the machine rewrites args.checkpoint.
+    """
+    def __init__(self, args, max_pending=2):
+        eval_args = copy.deepcopy(args)
+        eval_args.resume = ''
+        eval_args.teacher = ''
+        eval_args.compile = False
+        eval_args.distributed = False
+        eval_args.rank = 0
+        # the snapshots already hold the averaged weights, validation reads the images
+        eval_args.ema = 0
+        eval_args.feat_cache = ''
+        self.checkpoint_dir = os.path.join(args.checkpoint, args.name)
+
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(max_pending)
+        # not a daemon: the evaluator runs its own DataLoader workers
+        self.process = ctx.Process(target=evaluate_loop, args=(eval_args, self.queue))
+        self.process.start()
+
+    def submit(self, checkpoint_path, step):
+        snapshot = os.path.join(self.checkpoint_dir, 'eval_{}.pth.tar'.format(step))
+        shutil.copyfile(checkpoint_path, snapshot + '.tmp')
+        os.replace(snapshot + '.tmp', snapshot)
+        self.queue.put((snapshot, step))
+
+    def close(self):
+        """Finish the pending evaluations and stop the process."""
+        self.queue.put(None)
+        self.process.join()
+
+
+def evaluate_loop(args, jobs):
+    if args.eval_gpu_id != '':
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.eval_gpu_id
+
+    dataset_func = datasets.get_dataset(args)
+    val_loader = torch.utils.data.DataLoader(dataset_func('val',args),batch_size=args.test_batch, shuffle=False,
+        num_workers=args.workers, pin_memory=True)
+    machine = models.__dict__[args.models](datasets=(None, val_loader), args=args)
+
+    best_path = os.path.join(machine.args.checkpoint, 'model_best.pth.tar')
+    best_acc = -float('inf')
+    if os.path.exists(best_path):
+        best_acc = torch.load(best_path, map_location='cpu')['best_acc']
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        snapshot, step = job
+        state = torch.load(snapshot, map_location='cpu')
+        if state.get('prune_spec') is not None and machine.prune_spec is None:
+            machine.prune_spec = state['prune_spec']
+            apply_prune_spec(machine.model, machine.prune_spec)
+        machine.model.load_state_dict(state['state_dict'], strict=True)
+
+        machine.validate(step)
+        machine.flush()
+        if machine.metric > best_acc:
+            best_acc = state['best_acc'] = machine.metric
+            print('Saving Best Metric with PSNR:%s (step %s)' % (best_acc, step))
+            torch.save(state, best_path + '.tmp')
+            os.replace(best_path + '.tmp', best_path)
+        os.remove(snapshot)
+    machine.clean()
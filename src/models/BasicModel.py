@@ -4,7 +4,7 @@ import torch.backends.cudnn as cudnn
 from progress.bar import Bar
 import json
 import numpy as np
-from tensorboardX import SummaryWriter
+from src.utils.tb_logger import AsyncSummaryWriter
 
 import torch.optim
 import sys,shutil,os
@@ -22,6 +22,10 @@ import pytorch_ssim as pytorch_ssim
 from src.utils.osutils import mkdir_p, isfile, isdir, join
 from src.utils.parallel import DataParallelModel, DataParallelCriterion
 from src.utils.losses import VGGLoss
+from src.utils.pruning import apply_prune_spec
+from src.utils.distributed import is_main_process, strip_ddp_prefix, any_process
+from src.utils.train_state import get_rng_state
+from src.utils.checkpoint_writer import CheckpointWriter
 
 
 
@@ -43,7 +47,9 @@ class BasicModel(object):
         
         self.title = args.name
         self.args.checkpoint = os.path.join(args.checkpoint, self.title)
-        self.device = torch.device('cuda')
+        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        if getattr(args, 'distributed', False) and self.device.type == 'cuda':
+            self.device = torch.device('cuda', args.local_rank)
          # create checkpoint dir
         if not isdir(self.args.checkpoint):
             mkdir_p(self.args.checkpoint)
@@ -53,13 +59,28 @@ class BasicModel(object):
                             betas=(args.beta1,args.beta2),
                             weight_decay=args.weight_decay)  
         
-        if not self.args.evaluate:
-            self.writer = SummaryWriter(self.args.checkpoint+'/'+'ckpt')
+        # only rank 0 writes TensorBoard events and checkpoints under torchrun
+        self.is_main = is_main_process(self.args)
+        self.writer = None
+        if not self.args.evaluate and self.is_main:
+            # queued and written by a background thread, the training loop never waits for it
+            self.writer = AsyncSummaryWriter(self.args.checkpoint+'/'+'ckpt')
         
         self.best_acc = 0
         self.is_best = False
         self.current_epoch = 0
         self.metric = -100000
+        self.prune_spec = None
+        self.evaluator = None
+        # full training state: position (epoch, next iteration) of the last finished step,
+        # running meters of the epoch, and a restored state waiting for train()
+        self.train_position = (0, 0)
+        self.global_step = 0
+        self.train_meters = {}
+        self.train_state = None
+        self.stop_signal = None
+        self.stopped = False
+        self.checkpoint_writer = None # created by the first save (rank 0 only)
         self.hl = 6 if self.args.hl else 1
         self.count_gpu = len(range(torch.cuda.device_count()))
 
@@ -67,7 +88,7 @@ class BasicModel(object):
             # init perception loss
             self.vggloss = VGGLoss(self.args.sltype).to(self.device)
 
-        if self.count_gpu > 1 : # multiple
+        if self.count_gpu > 1 and not getattr(self.args, 'distributed', False): # multiple
             # self.model = DataParallelModel(self.model, device_ids=range(torch.cuda.device_count()))
             # self.loss = DataParallelCriterion(self.loss, device_ids=range(torch.cuda.device_count()))
             self.model.multi_gpu()
@@ -211,28 +232,44 @@ class BasicModel(object):
         if isinstance(current_checkpoint['optimizer'], torch.nn.DataParallel):
             current_checkpoint['optimizer'] = current_checkpoint['optimizer'].module
 
-        if self.args.start_epoch == 0:
-            self.args.start_epoch = current_checkpoint['epoch']
         self.metric = current_checkpoint['best_acc']
         items = list(current_checkpoint['state_dict'].keys())
 
-        ## restore the learning rate
-        lr = self.args.lr
-        for epoch in self.args.schedule:
-            if epoch <= self.args.start_epoch:
-                lr *= self.args.gamma
-        optimizers = [getattr(self.model, attr) for attr in dir(self.model) if  attr.startswith("optimizer") and getattr(self.model, attr) is not None]
-        for optimizer in optimizers:
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
+        train_state = current_checkpoint.get('train_state')
+        if train_state is not None and not self.args.evaluate:
+            # the optimizers (learning rate included) are restored by restore_training_state,
+            # train() continues the interrupted epoch
+            if self.args.start_epoch == 0:
+                self.args.start_epoch = train_state['epoch']
+            self.train_state = train_state
+        else:
+            if self.args.start_epoch == 0:
+                self.args.start_epoch = current_checkpoint['epoch']
+            ## restore the learning rate
+            lr = self.args.lr
+            for epoch in self.args.schedule:
+                if epoch <= self.args.start_epoch:
+                    lr *= self.args.gamma
+            optimizers = [getattr(self.model, attr) for attr in dir(self.model) if  attr.startswith("optimizer") and getattr(self.model, attr) is not None]
+            for optimizer in optimizers:
+                for param_group in optimizer.param_groups:
+                    param_group['lr'] = lr
         
         # ---------------- Load Model Weights --------------------------------------
+        if current_checkpoint.get('prune_spec') is not None:
+            # pruned checkpoint: shrink the network to the stored shapes first
+            self.prune_spec = current_checkpoint['prune_spec']
+            apply_prune_spec(self.model, self.prune_spec)
         self.model.load_state_dict(current_checkpoint['state_dict'], strict=True)
         print("=> loaded checkpoint '{}' (epoch {})"
                 .format(resume_path, current_checkpoint['epoch']))
         
-    def save_checkpoint(self,filename='checkpoint.pth.tar', snapshot=None):
-        is_best = True if self.best_acc < self.metric else False
+    def save_checkpoint(self,filename='checkpoint.pth.tar', snapshot=None, callback=None):
+        """Snapshot the checkpoint to host memory and leave the writing to the CheckpointWriter thread."""
+        if not self.is_main:
+            return
+        # with an AsyncEvaluator the evaluator process owns model_best.pth.tar
+        is_best = True if self.evaluator is None and self.best_acc < self.metric else False
 
         if is_best:
             self.best_acc = self.metric
@@ -240,31 +277,96 @@ class BasicModel(object):
         state = {
                     'epoch': self.current_epoch + 1,
                     'nets': self.args.nets,
-                    'state_dict': self.model.state_dict(),
+                    'state_dict': self.model_state_dict(),
                     'best_acc': self.best_acc,
                     'optimizer' : self.optimizer.state_dict() if self.optimizer else None,
+                    'train_state': self.training_state(),
                 }
+        if self.prune_spec is not None:
+            state['prune_spec'] = self.prune_spec
 
-        filepath = os.path.join(self.args.checkpoint, filename)
-        torch.save(state, filepath)
-
+        snapshot_name = None
         if snapshot and state['epoch'] % snapshot == 0:
-            shutil.copyfile(filepath, os.path.join(self.args.checkpoint, 'checkpoint_{}.pth.tar'.format(state.epoch)))
-        
-        if is_best:
-            self.best_acc = self.metric
-            print('Saving Best Metric with PSNR:%s'%self.best_acc)
-            if not os.path.exists(self.args.checkpoint): os.makedirs(self.args.checkpoint)
-            shutil.copyfile(filepath, os.path.join(self.args.checkpoint, 'model_best.pth.tar'))
+            snapshot_name = 'checkpoint_{}.pth.tar'.format(state['epoch'])
+
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(self.args.checkpoint, keep=self.args.keep_ckpt)
+        self.checkpoint_writer.save(state, self.global_step, filename=filename, is_best=is_best,
+                                    snapshot=snapshot_name, callback=callback)
+
+    def optimizers(self):
+        """Every optimizer of the machine by name, as stored in the training state."""
+        optimizers = {'optimizer': self.optimizer}
+        for attr in dir(self.model):
+            if attr.startswith('optimizer') and getattr(self.model, attr) is not None:
+                optimizers['model.' + attr] = getattr(self.model, attr)
+        return optimizers
+
+    def training_state(self):
+        """Everything besides the weights needed to continue training after the last finished step."""
+        epoch, iteration = self.train_position
+        state = {
+            'epoch': epoch,
+            'iteration': iteration,
+            'global_step': self.global_step,
+            'optimizers': {name: optimizer.state_dict() for name, optimizer in self.optimizers().items()},
+            'meters': {name: meter.state_dict() for name, meter in self.train_meters.items()},
+            'rng': get_rng_state(),
+        }
+        sampler = getattr(self.train_loader, 'sampler', None)
+        if hasattr(sampler, 'state_dict'):
+            state['sampler'] = sampler.state_dict()
+        return state
+
+    def restore_training_state(self, state):
+        """Load the optimizer states; position, meters and RNG are picked up by train()."""
+        optimizers = self.optimizers()
+        for name, optimizer_state in state['optimizers'].items():
+            if name in optimizers:
+                optimizers[name].load_state_dict(optimizer_state)
+        self.global_step = state['global_step']
+        sampler = getattr(self.train_loader, 'sampler', None)
+        if 'sampler' in state and hasattr(sampler, 'load_state_dict'):
+            sampler.load_state_dict(state['sampler'])
+        print("=> restored the training state (epoch {}, iteration {})".format(state['epoch'] + 1, state['iteration']))
+
+    def stop_requested(self, sync_step):
+        """Whether the StopSignal fired; under torchrun the ranks only agree on it at sync steps."""
+        if self.stop_signal is None:
+            return False
+        if not getattr(self.args, 'distributed', False):
+            return self.stop_signal.received
+        return sync_step and any_process(self.stop_signal.received, self.args, self.device)
+
+    def validate_and_save(self, step):
+        """Validate and checkpoint, or save and hand the checkpoint to the async evaluator."""
+        if self.evaluator is not None:
+            self.save_checkpoint(callback=lambda path: self.evaluator.submit(path, step))
+        else:
+            self.validate(step)
+            self.flush()
+            self.save_checkpoint()
+
+    def model_state_dict(self):
+        if getattr(self.args, 'distributed', False):
+            # checkpoints keep the single process layout, loadable without torchrun
+            return strip_ddp_prefix(self.model.state_dict())
+        return self.model.state_dict()
 
     def clean(self):
-        self.writer.close()
+        if self.writer is not None:
+            self.writer.close()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
 
     def record(self,k,v,epoch):
-        self.writer.add_scalar(k, v, epoch)
+        if self.writer is not None:
+            self.writer.add_scalar(k, v, epoch)
 
     def flush(self):
-        self.writer.flush()
+        if self.writer is not None:
+            self.writer.flush()
         sys.stdout.flush()
 
     def norm(self,x):
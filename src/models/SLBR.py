@@ -9,28 +9,38 @@ import torchvision
 from math import log10
 import numpy as np
 from .BasicModel import BasicModel
-from evaluation import AverageMeter, compute_IoU, FScore, compute_RMSE
+from evaluation import AverageMeter, DeviceMeter, sync_meters, compute_IoU, FScore, compute_RMSE
 import torch.nn.functional as F
 from src.utils.parallel import DataParallelModel, DataParallelCriterion
-from src.utils.losses import VGGLoss, l1_relative,is_dic
+from src.utils.losses import VGGLoss, l1_relative, is_dic, mask_pyramid
 from src.utils.imutils import im_to_numpy
 import skimage.io
 # from skimage.measure import compare_psnr,compare_ssim
 from skimage.metrics import peak_signal_noise_ratio as compare_psnr
 from skimage.metrics import structural_similarity as compare_ssim
 import torchvision
+import copy
+import contextlib
 import pytorch_iou
 import pytorch_ssim
+import src.networks as nets
+from src.utils.pruning import apply_prune_spec
+from src.utils.distributed import all_reduce_grads, barrier
+from src.utils.train_state import set_rng_state
+from src.utils.ema import ModelEMA
+from datasets.feature_cache_dataset import FeatureCacheDataset, build_feature_cache, cache_key, is_cache_valid
+from collections import OrderedDict
 
 class Losses(nn.Module):
-    def __init__(self, argx, device, norm_func, denorm_func):
+    def __init__(self, argx, device, norm_func, denorm_func, pretrained=True):
         super(Losses, self).__init__()
         self.args = argx
         self.masked_l1_loss, self.mask_loss = l1_relative, nn.BCELoss()
         self.l1_loss = nn.L1Loss()
 
         if self.args.lambda_content > 0:
-            self.vgg_loss = VGGLoss(self.args.sltype, style=self.args.lambda_style>0).to(device)
+            # pretrained=False: same cost without the VGG16 download (benchmarks, batch finder)
+            self.vgg_loss = VGGLoss(self.args.sltype, style=self.args.lambda_style>0, pretrained=pretrained).to(device)
         
         if self.args.lambda_iou > 0:
             self.iou_loss = pytorch_iou.IOU(size_average=True)
@@ -39,46 +49,135 @@ class Losses(nn.Module):
         self.gamma = 0.5
         self.norm = norm_func
         self.denorm = denorm_func
+        self.timer = None # per-term timing (benchmark.py train)
+        self.per_sample = False # also keep the detached per-sample loss (hard example sampling)
+        self.sample_loss = None
+
+    def phase(self, name):
+        return self.timer(name) if self.timer is not None else contextlib.nullcontext()
 
     def forward(self, synthesis, pred_ims, target, pred_ms, mask, threshold=0.5):
         pixel_loss, refine_loss, vgg_loss, mask_loss = [0]*4
         pred_ims = pred_ims if is_dic(pred_ims) else [pred_ims]
+        # network outputs may come out of autocast in half precision; the losses are reduced in fp32
+        pred_ims = [pred_im.float() for pred_im in pred_ims]
+        pred_ms = [pred_m.float() for pred_m in pred_ms]
         
         # reconstruction loss
-        pixel_loss += self.masked_l1_loss(pred_ims[-1], target, mask) # coarse stage
-        if len(pred_ims) > 1:
-            refine_loss = self.masked_l1_loss(pred_ims[0], target, mask) # refinement stage
-        
-        recov_imgs = [ self.denorm(pred_im*mask + (1-mask)*self.norm(target)) for pred_im in pred_ims ]        
-        pixel_loss += sum([self.l1_loss(im,target) for im in recov_imgs]) * 1.5
+        with self.phase('loss_pixel'):
+            pixel_loss += self.masked_l1_loss(pred_ims[-1], target, mask) # coarse stage
+            if len(pred_ims) > 1:
+                refine_loss = self.masked_l1_loss(pred_ims[0], target, mask) # refinement stage
+            
+            recov_imgs = [ self.denorm(pred_im*mask + (1-mask)*self.norm(target)) for pred_im in pred_ims ]        
+            pixel_loss += sum([self.l1_loss(im,target) for im in recov_imgs]) * 1.5
         
 
         if self.args.lambda_content > 0:
-            vgg_loss = [self.vgg_loss(im,target,mask) for im in recov_imgs]
-            vgg_loss = sum([vgg['content'] for vgg in vgg_loss]) * self.args.lambda_content + \
-                       sum([vgg['style'] for vgg in vgg_loss]) * self.args.lambda_style
-
-        # mask loss
-        pred_ms = [F.interpolate(ms, size=mask.shape[2:], mode='bilinear') for ms in pred_ms]
-        pred_ms = [pred_m.clamp(0,1) for pred_m in pred_ms]
-        mask = mask.clamp(0,1)
+            with self.phase('loss_vgg'):
+                # the target features are shared by the coarse and the refined prediction
+                target_vgg = self.vgg_loss.target_features(target, mask)
+                vgg_loss = [self.vgg_loss(im,target,mask,target=target_vgg) for im in recov_imgs]
+                vgg_loss = sum([vgg['content'] for vgg in vgg_loss]) * self.args.lambda_content + \
+                           sum([vgg['style'] for vgg in vgg_loss]) * self.args.lambda_style
+
+        # mask loss, BCE on sigmoid outputs is only safe in fp32
+        with self.phase('loss_mask'), torch.autocast(device_type=mask.device.type, enabled=False):
+            mask = mask.float().clamp(0,1)
+            if self.args.mask_pyramid:
+                # every map against the GT area-pooled to its own resolution, no upsampled copies
+                pyramid = mask_pyramid(mask, [tuple(ms.shape[2:]) for ms in pred_ms])
+                gt_ms = [pyramid[tuple(ms.shape[2:])] for ms in pred_ms]
+            else:
+                pred_ms = [F.interpolate(ms, size=mask.shape[2:], mode='bilinear') for ms in pred_ms]
+                gt_ms = [mask] * len(pred_ms)
+            pred_ms = [pred_m.clamp(0,1) for pred_m in pred_ms]
 
-        final_mask_loss = 0
-        final_mask_loss += self.mask_loss(pred_ms[0], mask)
-        
-        primary_mask = pred_ms[1::2][::-1]
-        self_calibrated_mask = pred_ms[2::2][::-1]
-        # primary prediction
-        primary_loss =  sum([self.mask_loss(pred_m, mask) * (self.gamma**i) for i,pred_m in enumerate(primary_mask)])
-        # self calibrated Branch
-        self_calibrated_loss =  sum([self.mask_loss(pred_m, mask) * (self.gamma**i) for i,pred_m in enumerate(self_calibrated_mask)])
-        if self.args.lambda_iou > 0:
-            self_calibrated_loss += sum([self.iou_loss(pred_m, mask) * (self.gamma**i) for i,pred_m in enumerate(self_calibrated_mask)]) * self.args.lambda_iou
+            final_mask_loss = 0
+            final_mask_loss += self.mask_loss(pred_ms[0], gt_ms[0])
+            
+            primary_mask = list(zip(pred_ms[1::2], gt_ms[1::2]))[::-1]
+            self_calibrated_mask = list(zip(pred_ms[2::2], gt_ms[2::2]))[::-1]
+            # primary prediction
+            primary_loss =  sum([self.mask_loss(pred_m, gt_m) * (self.gamma**i) for i,(pred_m, gt_m) in enumerate(primary_mask)])
+            # self calibrated Branch
+            self_calibrated_loss =  sum([self.mask_loss(pred_m, gt_m) * (self.gamma**i) for i,(pred_m, gt_m) in enumerate(self_calibrated_mask)])
+            if self.args.lambda_iou > 0:
+                self_calibrated_loss += sum([self.iou_loss(pred_m, gt_m) * (self.gamma**i) for i,(pred_m, gt_m) in enumerate(self_calibrated_mask)]) * self.args.lambda_iou
+
+            if self.per_sample:
+                # final image and mask terms of every sample, as weighted in the total loss
+                with torch.no_grad():
+                    l1 = (pred_ims[0] - target).abs().mul(mask).sum(dim=[1,2,3]) / (mask.sum(dim=[1,2,3]) + 1e-6)
+                    bce = F.binary_cross_entropy(pred_ms[0], gt_ms[0], reduction='none').mean(dim=[1,2,3])
+                    self.sample_loss = self.args.lambda_l1 * l1 + self.args.lambda_mask * bce
 
         mask_loss = final_mask_loss + self_calibrated_loss + self.lambda_primary * primary_loss
         return pixel_loss, refine_loss, vgg_loss, mask_loss
 
 
+class Distiller(nn.Module):
+    """Supervise a (smaller) student SLBR with a frozen teacher checkpoint.
+
+    The student matches the teacher's images, every mask map and the background
+    decoder features of every level; 1x1 adapters project the student features to
+    the teacher width.
+    """
+    def __init__(self, argx, student, device):
+        super(Distiller, self).__init__()
+        self.args = argx
+        checkpoint = torch.load(argx.teacher, map_location='cpu')
+        state_dict = checkpoint['state_dict']
+
+        targs = copy.copy(argx)
+        targs.start_filters = argx.teacher_start_filters
+        targs.k_refine = argx.teacher_k_refine
+        targs.use_refine = any(k.startswith('refinement.') for k in state_dict)
+        teacher = nets.__dict__[argx.nets](args=targs)
+        if checkpoint.get('prune_spec') is not None:
+            apply_prune_spec(teacher, checkpoint['prune_spec'])
+        teacher.load_state_dict(state_dict, strict=True)
+        teacher.eval()
+        for param in teacher.parameters():
+            param.requires_grad = False
+        self.teacher = teacher.to(device)
+
+        self.student_feats, self.teacher_feats = {}, {}
+        s_decoder = student.coarse_decoder
+        s_levels = getattr(s_decoder, 'module', s_decoder).up_convs_bg
+        t_levels = teacher.coarse_decoder.up_convs_bg
+        self.adapters = nn.ModuleList([
+            nn.Conv2d(s.conv1.out_channels, t.conv1.out_channels, 1, 1, 0) for s, t in zip(s_levels, t_levels)
+        ]).to(device)
+        for i, (s, t) in enumerate(zip(s_levels, t_levels)):
+            s.register_forward_hook(self._save_feat(self.student_feats, i))
+            t.register_forward_hook(self._save_feat(self.teacher_feats, i))
+
+    def _save_feat(self, feats, i):
+        def hook(module, inputs, output):
+            feats[i] = output
+        return hook
+
+    def forward(self, inputs, outputs):
+        with torch.no_grad():
+            t_ims, t_masks, _ = self.teacher(inputs)
+
+        s_ims, s_masks, _ = outputs
+        # final and coarse images
+        img_loss = F.l1_loss(s_ims[0].float(), t_ims[0].float())
+        if len(s_ims) > 1 and len(t_ims) > 1:
+            img_loss = img_loss + F.l1_loss(s_ims[-1].float(), t_ims[-1].float())
+
+        with torch.autocast(device_type=s_masks[0].device.type, enabled=False):
+            mask_loss = sum([F.binary_cross_entropy(s_m.float().clamp(0,1), t_m.float().clamp(0,1))
+                             for s_m, t_m in zip(s_masks, t_masks)])
+
+        feat_loss = sum([F.mse_loss(adapter(self.student_feats[i]).float(), self.teacher_feats[i].float())
+                         for i, adapter in enumerate(self.adapters)])
+
+        return self.args.lambda_kd * img_loss + self.args.lambda_kd_mask * mask_loss + self.args.lambda_kd_feat * feat_loss
+
+
 
 
 class SLBR(BasicModel):
@@ -88,8 +187,95 @@ class SLBR(BasicModel):
         if isinstance(self.model, nn.DataParallel):
             self.model = self.model.module
         self.model.set_optimizers()
+        # mixed precision: autocast dtype for forward/loss, one GradScaler shared by every optimizer (fp16 only)
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(self.args.amp)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.args.amp == 'fp16')
+        self.timer = None # per-phase timing of train_step (benchmark.py train)
         if self.args.resume != '':
             self.resume(self.args.resume)
+            if self.prune_spec is not None:
+                # the optimizers have to follow the pruned parameters
+                self.model.set_optimizers()
+        # exponential moving average of the weights, validated and saved as the checkpoint state_dict
+        self.ema = None
+        if self.args.ema > 0 and not self.args.evaluate and self.is_main:
+            ema_net = nets.__dict__[self.args.nets](args=self.args)
+            if self.prune_spec is not None:
+                apply_prune_spec(ema_net, self.prune_spec)
+            self.ema = ModelEMA(ema_net.to(self.device), self.model, decay=self.args.ema, every=self.args.ema_freq)
+            if self.args.resume != '' and self.train_state is None:
+                print('==> no training state in the checkpoint, the EMA starts from its weights')
+            if self.args.compile:
+                self.ema.module.compile()
+        if self.train_state is not None and 'raw_state_dict' in self.train_state:
+            # an EMA checkpoint's state_dict holds the averaged weights (the EMA starts from them),
+            # training continues from the raw ones
+            self.model.load_state_dict(self.train_state['raw_state_dict'], strict=True)
+
+        if self.args.feat_cache != '' and not self.args.evaluate and self.train_loader is not None:
+            self.use_feature_cache(self.args.feat_cache)
+
+        self.distiller = None
+        if self.args.teacher != '' and not self.args.evaluate:
+            self.distiller = Distiller(self.args, self.model, self.device)
+            self.optimizer_kd = torch.optim.Adam(self.distiller.adapters.parameters(), lr=self.args.lr)
+            print('==> distilling from teacher %s' % self.args.teacher)
+
+        if getattr(self.args, 'distributed', False):
+            self.model.distributed([self.device.index] if self.device.type == 'cuda' else None)
+
+        if self.args.compile:
+            # in-place, so state_dict keys and the optimizer attributes stay untouched
+            self.model.compile()
+
+        if self.train_state is not None:
+            self.restore_training_state(self.train_state)
+
+    def use_feature_cache(self, root):
+        """Freeze the CoarseEncoder and train the rest from its cached outputs (built here if missing or stale)."""
+        for p in self.model.encoder.parameters():
+            p.requires_grad = False
+        dataset = self.train_loader.dataset
+        key = cache_key(self.model.encoder, self.args, len(dataset))
+        if self.is_main and not is_cache_valid(root, key):
+            build_feature_cache(self.model, dataset, root, key, self.device, batch_size=self.args.test_batch,
+                                workers=self.args.workers, norm=self.norm)
+        barrier(self.args)
+        # same sampler (order, resume position, hard example scores) and batch over the cached samples
+        self.train_loader = torch.utils.data.DataLoader(FeatureCacheDataset(root), batch_size=self.train_loader.batch_size,
+            sampler=self.train_loader.sampler, num_workers=self.args.workers, pin_memory=True)
+        print('==> training the decoders and the refinement from the encoder features in %s' % root)
+
+    def optimizers(self):
+        optimizers = super(SLBR, self).optimizers()
+        if self.distiller is not None:
+            optimizers['optimizer_kd'] = self.optimizer_kd
+        return optimizers
+
+    def training_state(self):
+        state = super(SLBR, self).training_state()
+        state['scaler'] = self.scaler.state_dict()
+        if self.ema is not None:
+            state['raw_state_dict'] = super(SLBR, self).model_state_dict()
+            state['ema'] = self.ema.counters()
+        if self.distiller is not None:
+            state['kd_adapters'] = self.distiller.adapters.state_dict()
+        return state
+
+    def restore_training_state(self, state):
+        super(SLBR, self).restore_training_state(state)
+        if state.get('scaler'):
+            self.scaler.load_state_dict(state['scaler'])
+        if self.distiller is not None and 'kd_adapters' in state:
+            self.distiller.adapters.load_state_dict(state['kd_adapters'])
+        if self.ema is not None and 'ema' in state:
+            self.ema.load_state_dict(state['ema'])
+
+    def model_state_dict(self):
+        if self.ema is not None:
+            # the averaged weights are what gets validated, exported as model_best and tested
+            return self.ema.state_dict()
+        return super(SLBR, self).model_state_dict()
        
     def train(self,epoch):
 
@@ -97,49 +283,75 @@ class SLBR(BasicModel):
 
         batch_time = AverageMeter()
         data_time = AverageMeter()
-        losses_meter = AverageMeter()
-        loss_mask_meter = AverageMeter()
-        loss_vgg_meter = AverageMeter()
-        loss_refine_meter = AverageMeter()
-        f1_meter = AverageMeter()
+        # device-side accumulation, brought to host only on logging steps
+        losses_meter = DeviceMeter()
+        loss_mask_meter = DeviceMeter()
+        loss_vgg_meter = DeviceMeter()
+        loss_refine_meter = DeviceMeter()
+        f1_meter = DeviceMeter()
+        loss_kd_meter = DeviceMeter()
+        self.train_meters = OrderedDict([('loss_L1', losses_meter), ('loss_mask', loss_mask_meter), ('loss_vgg', loss_vgg_meter),
+                                         ('loss_refine', loss_refine_meter), ('mask_F1', f1_meter), ('loss_kd', loss_kd_meter)])
+        meters = list(self.train_meters.values())
         # switch to train mode
         self.model.train()
 
+        # continue a restored epoch: same sample order without the trained batches, same meters and RNG streams
+        state, start = self.train_state, 0
+        self.train_state = None
+        if state is not None and state['epoch'] == epoch:
+            start = state['iteration']
+            self.train_loader.sampler.set_start(start * self.train_loader.batch_size)
+            for name, meter in self.train_meters.items():
+                if name in state['meters']:
+                    meter.load_state_dict(state['meters'][name], self.device)
+            if start == 0:
+                set_rng_state(state['rng'])
+        train_iter = iter(self.train_loader) # draws the worker seed from the torch RNG
+        if start > 0:
+            set_rng_state(state['rng'])
+
         end = time.time()
         bar = Bar('Processing {} '.format(self.args.nets), max=len(self.train_loader))
-        for i, batches in enumerate(self.train_loader):
+        sampler = self.train_loader.sampler
+        self.loss.per_sample = hasattr(sampler, 'update')
+        # gradient accumulation: the optimizers step once per accum_steps micro-batches
+        accum = max(1, self.args.accum_steps)
+        stop = False
+        for i, batches in enumerate(train_iter, start):
+            # measure data loading time
+            data_time.update(time.time() - end)
             current_index = len(self.train_loader) * epoch + i
 
-            inputs = batches['image'].float().to(self.device)
-            target = batches['target'].float().to(self.device)
-            mask = batches['mask'].float().to(self.device)
-            # wm =  batches['wm'].float().to(self.device)
-            # alpha_gt = batches['alpha'].float().to(self.device)
-            img_path = batches['img_path']
-            
-            outputs = self.model(self.norm(inputs))
-            self.model.zero_grad_all()
-            coarse_loss, refine_loss, style_loss, mask_loss = self.loss(
-                inputs,outputs[0],self.norm(target),outputs[1],mask)
-            
-            total_loss = self.args.lambda_l1*(coarse_loss+refine_loss) + self.args.lambda_mask * (mask_loss)  + style_loss
-            
-            # compute gradient and do SGD step
-            total_loss.backward()
-            self.model.step_all()
+            # the last group of an epoch may be shorter; its micro-batches are weighted by its own size
+            group_start = max(i - i % accum, start)
+            group = min(group_start - group_start % accum + accum, len(self.train_loader)) - group_start
+            last_micro = i + 1 == group_start + group
+            inputs, target, mask, outputs, (coarse_loss, refine_loss, style_loss, mask_loss, kd_loss) = \
+                self.train_step(batches, group, first=i == group_start, last=last_micro)
+            if self.distiller is not None:
+                loss_kd_meter.update(kd_loss, inputs.size(0))
 
             # measure accuracy and record loss
-            losses_meter.update(coarse_loss.item(), inputs.size(0))
-            loss_mask_meter.update(mask_loss.item(), inputs.size(0))
-            if isinstance(refine_loss,int):
-                loss_refine_meter.update(refine_loss, inputs.size(0))
-            else:
-                loss_refine_meter.update(refine_loss.item(), inputs.size(0))
+            losses_meter.update(coarse_loss, inputs.size(0))
+            loss_mask_meter.update(mask_loss, inputs.size(0))
+            loss_refine_meter.update(refine_loss, inputs.size(0))
             
-            f1 = FScore(outputs[1][0], mask).item()
+            f1 = FScore(outputs[1][0].float(), mask)
             f1_meter.update(f1, inputs.size(0))
             if self.args.lambda_content > 0  and not isinstance(style_loss,int):
-                loss_vgg_meter.update(style_loss.item(), inputs.size(0))
+                loss_vgg_meter.update(style_loss, inputs.size(0))
+
+            log_step = current_index % self.args.log_freq == 0 or i % self.args.log_freq == 0
+            if log_step:
+                sync_meters(*meters)
+
+            # the training state only ever points at the end of a whole group
+            save = False
+            if last_micro:
+                previous_step = self.global_step
+                self.train_position, self.global_step = (epoch, i + 1), current_index + 1
+                save = self.args.ckpt_freq > 0 and self.global_step // self.args.ckpt_freq > previous_step // self.args.ckpt_freq
 
             # measure elapsed timec
             batch_time.update(time.time() - end)
@@ -159,35 +371,130 @@ class SLBR(BasicModel):
                         loss_mask=loss_mask_meter.avg,
                         mask_f1=f1_meter.avg,
                         )
-            if current_index % 100 == 0:
+            if current_index % self.args.log_freq == 0:
                 print(suffix)
 
             if self.args.freq > 0 and current_index % self.args.freq == 0:
-                self.validate(current_index)
-                self.flush()
-                self.save_checkpoint()
-            if i % 100 == 0:
+                if self.is_main:
+                    self.validate_and_save(current_index)
+                barrier(self.args)
+            if i % self.args.log_freq == 0 and self.is_main:
                 self.record('train/loss_L2', losses_meter.avg, current_index)
                 self.record('train/loss_Refine', loss_refine_meter.avg, current_index)
                 self.record('train/loss_VGG', loss_vgg_meter.avg, current_index)
                 self.record('train/loss_Mask', loss_mask_meter.avg, current_index)
                 self.record('train/mask_F1', f1_meter.avg, current_index)
+                if self.distiller is not None:
+                    self.record('train/loss_KD', loss_kd_meter.avg, current_index)
 
-                mask_pred = outputs[1][0]
-                bg_pred = self.denorm(outputs[0][0]*mask_pred + (1-mask_pred)*self.norm(inputs))
-                show_size = 5 if inputs.shape[0] > 5 else inputs.shape[0]
-                self.image_display = torch.cat([
-                    inputs[0:show_size].detach().cpu(),             # input image
-                    target[0:show_size].detach().cpu(),                        # ground truth
-                    bg_pred[0:show_size].detach().cpu(),       # refine out
-                    mask[0:show_size].detach().cpu().repeat(1,3,1,1),
-                    outputs[1][0][0:show_size].detach().cpu().repeat(1,3,1,1),
-                    outputs[1][-2][0:show_size].detach().cpu().repeat(1,3,1,1)
-                ],dim=0)
-                image_dis = torchvision.utils.make_grid(self.image_display, nrow=show_size)
-                self.writer.add_image('Image', image_dis, current_index)
+            if self.args.log_image_freq > 0 and i % self.args.log_image_freq == 0 and self.is_main:
+                self.log_preview(inputs, target, mask, outputs, current_index)
             del outputs
 
+            stop = stop or self.stop_requested(log_step)
+            if last_micro and (stop or save):
+                if self.loss.per_sample:
+                    sampler.sync(self.args)
+                if self.is_main:
+                    self.save_checkpoint()
+                barrier(self.args)
+            if last_micro and stop:
+                print('==> training state saved at epoch %d, iteration %d, stopping' % (epoch + 1, i + 1))
+                self.stopped = True
+                return
+
+        if self.loss.per_sample:
+            # the next epoch is drawn from the scores of every rank
+            sampler.sync(self.args)
+        # the next epoch starts from scratch
+        self.train_position = (epoch + 1, 0)
+        self.train_meters = {}
+
+
+    def phase(self, name):
+        return self.timer(name) if self.timer is not None else contextlib.nullcontext()
+
+    def train_step(self, batches, group=1, first=True, last=True):
+        """One micro-batch of a group of `group`: device copy and batch augmentation, forward (the
+        decoders only on cached encoder features), losses, hard example scores and distillation,
+        backward of the loss / group and, with the last micro-batch, the optimizer steps and the
+        EMA update. self.timer (benchmark.py train) times the phases.
+
+        Returns inputs, target, mask, outputs and the loss terms (coarse, refine, vgg, mask, kd).
+        """
+        with self.phase('to_device'):
+            inputs = batches['image'].float().to(self.device)
+            target = batches['target'].float().to(self.device)
+            mask = batches['mask'].float().to(self.device)
+            batch_transform = getattr(self.train_loader.dataset, 'batch_transform', None)
+            if batch_transform is not None:
+                keep = batches['keep_wm'].to(self.device) if 'keep_wm' in batches else None
+                (inputs, target), (mask,) = batch_transform([inputs, target], [mask], keep=keep)
+        if first:
+            self.model.zero_grad_all()
+            if self.distiller is not None:
+                self.optimizer_kd.zero_grad()
+
+        kd_loss = 0
+        # DDP all-reduces the gradients only with the last micro-batch of a group
+        grad_sync = contextlib.nullcontext() if last else self.model.no_sync()
+        with grad_sync:
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                with self.phase('forward'):
+                    if 'code' in batches:
+                        # --feat_cache: the frozen encoder's outputs come from the cache
+                        fmt = self.model.memory_format
+                        code = batches['code'].to(self.device).float().contiguous(memory_format=fmt)
+                        skips = [skip.to(self.device).float().contiguous(memory_format=fmt) for skip in batches['skips']]
+                        outputs = self.model.decode(self.norm(inputs).contiguous(memory_format=fmt), code, skips)
+                    else:
+                        outputs = self.model(self.norm(inputs))
+                with self.phase('loss'):
+                    coarse_loss, refine_loss, style_loss, mask_loss = self.loss(
+                        inputs,outputs[0],self.norm(target),outputs[1],mask)
+
+                    total_loss = self.args.lambda_l1*(coarse_loss+refine_loss) + self.args.lambda_mask * (mask_loss)  + style_loss
+                    if self.loss.per_sample:
+                        self.train_loader.sampler.update(batches['idx'], self.loss.sample_loss)
+                    if self.distiller is not None:
+                        kd_loss = self.distiller(self.norm(inputs), outputs)
+                        total_loss = total_loss + kd_loss
+
+            with self.phase('backward'):
+                self.scaler.scale(total_loss / group).backward()
+        if last:
+            with self.phase('optimizer'):
+                if self.ema is not None:
+                    # the side stream may still be reading the weights of the last step
+                    self.ema.wait()
+                self.model.step_all(self.scaler)
+                if self.distiller is not None:
+                    # the adapters are not wrapped by DDP
+                    all_reduce_grads(self.distiller.adapters.parameters(), self.args)
+                    self.scaler.step(self.optimizer_kd)
+                self.scaler.update()
+                if self.ema is not None:
+                    self.ema.update()
+        return inputs, target, mask, outputs, (coarse_loss, refine_loss, style_loss, mask_loss, kd_loss)
+
+    def log_preview(self, inputs, target, mask, outputs, step):
+        """Queue a downsampled input / target / output / mask grid; nothing is copied to host here."""
+        with torch.no_grad():
+            mask_pred = outputs[1][0]
+            bg_pred = self.denorm(outputs[0][0]*mask_pred + (1-mask_pred)*self.norm(inputs))
+            show_size = 5 if inputs.shape[0] > 5 else inputs.shape[0]
+            preview = torch.cat([
+                inputs[0:show_size].float(),             # input image
+                target[0:show_size].float(),                        # ground truth
+                bg_pred[0:show_size].float(),       # refine out
+                mask[0:show_size].float().expand(-1,3,-1,-1),
+                outputs[1][0][0:show_size].float().expand(-1,3,-1,-1),
+                outputs[1][-2][0:show_size].float().expand(-1,3,-1,-1)
+            ],dim=0)
+            h, w = preview.shape[2:]
+            if h > self.args.log_image_size:
+                preview = F.interpolate(preview, size=(self.args.log_image_size, max(1, w * self.args.log_image_size // h)), mode='area')
+        self.writer.add_image_grid('Image', preview, show_size, step)
 
     def validate(self, epoch):
 
@@ -195,22 +502,27 @@ class SLBR(BasicModel):
         
         batch_time = AverageMeter()
         data_time = AverageMeter()
-        losses_meter = AverageMeter()
-        loss_mask_meter = AverageMeter()
-        psnr_meter = AverageMeter()
-        fpsnr_meter = AverageMeter()
-        ssim_meter = AverageMeter()
-        rmse_meter = AverageMeter()
-        rmsew_meter = AverageMeter()
+        losses_meter = DeviceMeter()
+        loss_mask_meter = DeviceMeter()
+        psnr_meter = DeviceMeter()
+        fpsnr_meter = DeviceMeter()
+        ssim_meter = DeviceMeter()
+        rmse_meter = DeviceMeter()
+        rmsew_meter = DeviceMeter()
         
 
-        coarse_psnr_meter = AverageMeter()
-        coarse_rmsew_meter = AverageMeter()
+        coarse_psnr_meter = DeviceMeter()
+        coarse_rmsew_meter = DeviceMeter()
 
-        iou_meter = AverageMeter()
-        f1_meter = AverageMeter()
+        iou_meter = DeviceMeter()
+        f1_meter = DeviceMeter()
+        meters = [losses_meter, loss_mask_meter, psnr_meter, fpsnr_meter, ssim_meter, rmse_meter, rmsew_meter,
+                  coarse_psnr_meter, coarse_rmsew_meter, iou_meter, f1_meter]
         # switch to evaluate mode
-        self.model.eval()
+        model = self.ema.module if self.ema is not None else self.model
+        if self.ema is not None:
+            self.ema.wait()
+        model.eval()
 
         end = time.time()
         bar = Bar('Processing {} '.format(self.args.nets), max=len(self.val_loader))
@@ -224,7 +536,7 @@ class SLBR(BasicModel):
                 mask = batches['mask'].to(self.device)
                 # alpha_gt = batches['alpha'].float().to(self.device)
 
-                outputs = self.model(self.norm(inputs))
+                outputs = model(self.norm(inputs))
                 imoutput,immask,imwatermark = outputs
                 
                 immask = immask[0]
@@ -237,26 +549,29 @@ class SLBR(BasicModel):
                 imfinal = self.denorm(imoutput*immask + self.norm(inputs)*(1-immask))
 
                 eps = 1e-6
-                psnr = 10 * log10(1 / F.mse_loss(imfinal,target).item()) 
+                # psnr in float64 on the device, as log10() of the host value was
+                psnr = 10 * torch.log10(1 / F.mse_loss(imfinal,target).double()) 
                 fmse = F.mse_loss(imfinal*mask, target*mask, reduction='none').sum(dim=[1,2,3]) / (mask.sum(dim=[1,2,3])*3+eps)
-                fpsnr = 10 * torch.log10(1 / fmse).mean().item()
+                fpsnr = 10 * torch.log10(1 / fmse).mean()
                 ssim = pytorch_ssim.ssim(imfinal,target)
                 if imcoarse is not None:
-                    psnr_coarse = 10 * log10(1 / F.mse_loss(imcoarse,target).item())  
-                    rmsew_coarse = compute_RMSE(imcoarse, target, mask, is_w=True)
+                    psnr_coarse = 10 * torch.log10(1 / F.mse_loss(imcoarse,target).double())  
+                    rmsew_coarse = compute_RMSE(imcoarse, target, mask, is_w=True, to_host=False)
                     coarse_psnr_meter.update(psnr_coarse, inputs.size(0))
                     coarse_rmsew_meter.update(rmsew_coarse, inputs.size(0))
 
                 psnr_meter.update(psnr, inputs.size(0))
                 fpsnr_meter.update(fpsnr, inputs.size(0))
                 ssim_meter.update(ssim, inputs.size(0))
-                rmse_meter.update(compute_RMSE(imfinal,target,mask),inputs.size(0))
-                rmsew_meter.update(compute_RMSE(imfinal,target,mask,is_w=True), inputs.size(0))
+                rmse_meter.update(compute_RMSE(imfinal,target,mask,to_host=False),inputs.size(0))
+                rmsew_meter.update(compute_RMSE(imfinal,target,mask,is_w=True,to_host=False), inputs.size(0))
 
-                iou = compute_IoU(immask, mask)
+                iou = compute_IoU(immask, mask, to_host=False)
                 iou_meter.update(iou, inputs.size(0))
-                f1 = FScore(immask, mask).item()
+                f1 = FScore(immask, mask)
                 f1_meter.update(f1, inputs.size(0))
+                if i % self.args.log_freq == 0 or i == len(self.val_loader) - 1:
+                    sync_meters(*meters)
                 # measure elapsed time
                 batch_time.update(time.time() - end)
                 end = time.time()
@@ -296,7 +611,7 @@ class SLBR(BasicModel):
                             iou=iou_meter.avg,
                             f1=f1_meter.avg
                             )
-                if i%100 == 0:
+                if i%self.args.log_freq == 0:
                     print(suffix)
                 # bar.next()
         print("Total:")
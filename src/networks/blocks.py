@@ -329,7 +329,8 @@ class SelfAttentionSimple(nn.Module):
         key = self.k_conv(key_in)
         keys = list(key.split(c,dim=1))
         
-        importance_map = torch.where(mask >= self.threshold, torch.ones_like(mask), torch.zeros_like(mask)).to(mask.device)
+        # fp32 map: the pooled key/value statistics below sum over h*w and must not accumulate in half precision
+        importance_map = (mask >= self.threshold).float()
         s_area = torch.clamp_min(torch.sum(importance_map, dim=[2,3]), self.min_area)[:,0:1]
         if self.k_center != 2:
             keys = [torch.sum(k*importance_map, dim=[2,3]) / s_area for k in keys] # b,c * k
@@ -339,14 +340,12 @@ class SelfAttentionSimple(nn.Module):
                 torch.sum(keys[1]*(1-importance_map), dim=[2,3]) / (keys[1].shape[2]*keys[1].shape[3] - s_area + eps)
             ]
 
-        f_query = query # b, c, h, w
-        f_key = [k.reshape(b,c,1,1).repeat(1, 1, f_query.size(2),f_query.size(3)) for k in keys]
-        attention_scores = []
-        for k in f_key:
-            combine_qk = torch.cat([f_query, k],dim=1).tanh() # tanh
-            sk = self.sim_func(combine_qk)
-            attention_scores.append(sk)
-        s = ascore = torch.cat(attention_scores, dim=1) # b,k,h,w
+        # sim_func(tanh(cat[q, k])) with k constant over h,w: split the 1x1 conv into its query and
+        # key halves instead of tiling every key to b,c,h,w
+        f_query = F.conv2d(query.tanh(), self.sim_func.weight[:, :c], self.sim_func.bias) # b, 1, h, w
+        w_key = self.sim_func.weight[:, c:].reshape(1, c)
+        f_key = torch.stack([k.tanh() @ w_key.t() for k in keys], dim=1) # b, k, 1
+        s = ascore = f_query + f_key.unsqueeze(-1) # b,k,h,w
         
         s = s.permute(0,2,3,1) # b,h,w,k
         v = self.v_conv(key_in)
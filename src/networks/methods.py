@@ -14,7 +14,7 @@ from src.networks.resunet import SLBR
 
 # our method
 def slbr(**kwargs):
-    return SLBR(args=kwargs['args'], shared_depth=1, blocks=3, long_skip=True)
+    return SLBR(args=kwargs['args'], shared_depth=1, blocks=3, long_skip=True, start_filters=kwargs['args'].start_filters)
 
 
 
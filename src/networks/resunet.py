@@ -3,8 +3,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from src.networks.blocks import UpConv, DownConv, MBEBlock, SMRBlock, CFFBlock, ResDownNew, ResUpNew, ECABlock
+from torch.utils.checkpoint import checkpoint
 import scipy.stats as st
 import itertools
+import contextlib
 import cv2
 
 def weight_init(m):
@@ -17,6 +19,32 @@ def reset_params(model):
     for i, m in enumerate(model.modules()):
         weight_init(m)
 
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    # the recomputed forward must not update the BatchNorm running stats or batch count a second time
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, None if m.num_batches_tracked is None else m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (mom, tracked) in zip(bns, saved):
+            m.momentum = mom
+            if tracked is not None:
+                m.num_batches_tracked.copy_(tracked)
+
+def maybe_checkpoint(enabled, fn, *inputs, **kwargs):
+    """Call fn, recomputing its activations in backward instead of storing them when enabled."""
+    owner = getattr(fn, '__self__', fn)
+    if enabled and owner.training and torch.is_grad_enabled():
+        if torch.compiler.is_compiling():
+            # the compiled graph replays the recompute itself, context_fn is not traceable
+            return checkpoint(fn, *inputs, use_reentrant=False, **kwargs)
+        context_fn = lambda: (contextlib.nullcontext(), frozen_bn_stats(owner))
+        return checkpoint(fn, *inputs, use_reentrant=False, context_fn=context_fn, **kwargs)
+    return fn(*inputs, **kwargs)
+
 class CoarseEncoder(nn.Module):
     def __init__(self, in_channels=3, depth=3, blocks=1, start_filters=32, residual=True, norm=nn.BatchNorm2d, act=F.relu):
         super(CoarseEncoder, self).__init__()
@@ -32,12 +60,13 @@ class CoarseEncoder(nn.Module):
             down_conv = DownConv(ins, outs, blocks, pooling=pooling, residual=residual, norm=norm, act=act)
             self.down_convs.append(down_conv)
         self.down_convs = nn.ModuleList(self.down_convs)
+        self.grad_ckpt = False
         reset_params(self)
 
     def forward(self, x):
         encoder_outs = []
         for d_conv in self.down_convs:
-            x, before_pool = d_conv(x)
+            x, before_pool = maybe_checkpoint(self.grad_ckpt, d_conv, x)
             encoder_outs.append(before_pool)
         return x, encoder_outs
 
@@ -76,6 +105,7 @@ class SharedBottleNeck(nn.Module):
         # task-specific channel attention blocks
         self.up_im_atts = nn.ModuleList(self.up_im_atts)
         self.up_mask_atts = nn.ModuleList(self.up_mask_atts)
+        self.grad_ckpt = False
 
         reset_params(self)
 
@@ -86,7 +116,7 @@ class SharedBottleNeck(nn.Module):
         x = input
         for i, d_conv in enumerate(self.down_convs):
             # d_conv, attn = nets
-            x, before_pool = d_conv(x)
+            x, before_pool = maybe_checkpoint(self.grad_ckpt, d_conv, x)
             im_encoder_outs.append(before_pool)
             mask_encoder_outs.append(before_pool)
         x_im = x
@@ -99,7 +129,7 @@ class SharedBottleNeck(nn.Module):
             before_pool = None
             if im_encoder_outs is not None:
                 before_pool = im_encoder_outs[-(i+2)]
-            x = up_conv(x, before_pool,se=attn)
+            x = maybe_checkpoint(self.grad_ckpt, up_conv, x, before_pool, se=attn)
         x_im = x
 
         x = x_mask       
@@ -108,11 +138,25 @@ class SharedBottleNeck(nn.Module):
             before_pool = None
             if mask_encoder_outs is not None:
                 before_pool = mask_encoder_outs[-(i+2)]
-            x = up_conv(x, before_pool, se = attn)
+            x = maybe_checkpoint(self.grad_ckpt, up_conv, x, before_pool, se=attn)
         x_mask = x
 
         return x_im, x_mask
 
+    def forward_mask(self, input):
+        # mask half only, used by the detector
+        mask_encoder_outs = []
+        x = input
+        for d_conv in self.down_convs:
+            x, before_pool = d_conv(x)
+            mask_encoder_outs.append(before_pool)
+
+        for i, nets in enumerate(zip(self.up_convs, self.up_mask_atts)):
+            up_conv, attn = nets
+            before_pool = mask_encoder_outs[-(i+2)]
+            x = up_conv(x, before_pool, se = attn)
+        return x
+
 class CoarseDecoder(nn.Module):
     def __init__(self, args, in_channels=512, out_channels=3, norm='bn',act=F.relu, depth=5, blocks=1, residual=True,
                  concat=True, use_att=False):
@@ -146,32 +190,37 @@ class CoarseDecoder(nn.Module):
         self.atts_bg = nn.ModuleList(self.atts_bg)
         self.up_convs_mask = nn.ModuleList(self.up_convs_mask)
         self.atts_mask = nn.ModuleList(self.atts_mask)
+        self.grad_ckpt = False
         
         reset_params(self)
 
+    def forward_level(self, i, bg_x, mask_x, before_pool):
+        up_bg, up_mask = self.up_convs_bg[i], self.up_convs_mask[i]
+        if self.use_att:
+            mask_before_pool = self.atts_mask[i](before_pool)
+            bg_before_pool = self.atts_bg[i](before_pool)
+        smr_outs = up_mask(mask_x, mask_before_pool)
+        mask_x= smr_outs['feats'][0]
+        primary_map, self_calibrated_map = smr_outs['attn_maps']
+
+        bg_x = up_bg(bg_x, bg_before_pool, self_calibrated_map.detach())
+        return bg_x, mask_x, primary_map, self_calibrated_map
+
     def forward(self, bg, fg, mask, encoder_outs=None):
         bg_x = bg
         fg_x = fg
         mask_x = mask
         mask_outs = []
         bg_outs = []
-        for i, up_convs in enumerate(zip(self.up_convs_bg, self.up_convs_mask)):
-            up_bg, up_mask = up_convs
+        for i in range(len(self.up_convs_bg)):
             before_pool = None
             if encoder_outs is not None:
                 before_pool = encoder_outs[-(i+1)]
 
-            if self.use_att:
-                mask_before_pool = self.atts_mask[i](before_pool)
-                bg_before_pool = self.atts_bg[i](before_pool)
-            smr_outs = up_mask(mask_x, mask_before_pool)
-            mask_x= smr_outs['feats'][0]
-            primary_map, self_calibrated_map = smr_outs['attn_maps']
+            bg_x, mask_x, primary_map, self_calibrated_map = maybe_checkpoint(
+                self.grad_ckpt, self.forward_level, i, bg_x, mask_x, before_pool)
             mask_outs.append(primary_map)
             mask_outs.append(self_calibrated_map)
-
-            
-            bg_x = up_bg(bg_x, bg_before_pool, self_calibrated_map.detach())
             bg_outs.append(bg_x)
 
         if self.conv_final_bg is not None:
@@ -180,6 +229,19 @@ class CoarseDecoder(nn.Module):
             bg_outs = [bg_x] + bg_outs
         return bg_outs, [mask_x] + mask_outs, None
 
+    def forward_mask(self, mask, encoder_outs):
+        # SMR branch only, the background branch is skipped
+        mask_x = mask
+        mask_outs = []
+        for i, up_mask in enumerate(self.up_convs_mask):
+            before_pool = encoder_outs[-(i+1)]
+            if self.use_att:
+                before_pool = self.atts_mask[i](before_pool)
+            smr_outs = up_mask(mask_x, before_pool)
+            mask_x = smr_outs['feats'][0]
+            mask_outs.extend(smr_outs['attn_maps'])
+        return [mask_outs[-1]] + mask_outs
+
 
 #################################################################
 #           Refinement Stage
@@ -214,6 +276,7 @@ class Refinement(nn.Module):
             nn.LeakyReLU(0.2),
             nn.Conv2d(ngf, out_channels, 1,1,0)
         ])     
+        self.grad_ckpt = False
         
     def forward(self, input, coarse_bg, mask, encoder_outs, decoder_outs):
         if self.n_skips < 1:
@@ -232,13 +295,13 @@ class Refinement(nn.Module):
         xin = torch.cat([coarse_bg, mask], dim=1)
         x = self.conv_in(xin)
         
-        x,d1 = self.down1(x + dec_feat2) # 128,256
-        x,d2 = self.down2(x + dec_feat3) # 64,128
-        x,d3 = self.down3(x + dec_feat4) # 32,64
+        x,d1 = maybe_checkpoint(self.grad_ckpt, self.down1, x + dec_feat2) # 128,256
+        x,d2 = maybe_checkpoint(self.grad_ckpt, self.down2, x + dec_feat3) # 64,128
+        x,d3 = maybe_checkpoint(self.grad_ckpt, self.down3, x + dec_feat4) # 32,64
 
         xs = [d1,d2,d3]
         for block in self.cff_blocks:
-            xs = block(xs)
+            xs = maybe_checkpoint(self.grad_ckpt, block, xs)
 
         xs = [F.interpolate(x_hr, size=coarse_bg.shape[2:][::-1], mode='bilinear') for x_hr in xs]
         im = self.out_conv(torch.cat(xs,dim=1))
@@ -279,10 +342,35 @@ class SLBR(nn.Module):
         
         # refinement stage
         if args.use_refine:
-            self.refinement = Refinement(in_channels=4, out_channels=3, shared_depth=1, n_cff=args.k_refine, n_skips=args.k_skip_stage)
+            self.refinement = Refinement(in_channels=4, out_channels=3, shared_depth=1, ngf=start_filters, n_cff=args.k_refine, n_skips=args.k_skip_stage)
         else:
             self.refinement = None
 
+        self.grad_ckpt_stage = False
+        self.set_grad_checkpointing(getattr(args, 'grad_ckpt', 'none'))
+        self.memory_format = torch.contiguous_format
+        self.set_channels_last(getattr(args, 'channels_last', False))
+
+    def set_channels_last(self, enabled=True):
+        """Keep weights and activations in NHWC (channels_last) layout; inputs are converted in forward."""
+        self.memory_format = torch.channels_last if enabled else torch.contiguous_format
+        self.to(memory_format=self.memory_format)
+
+    def set_grad_checkpointing(self, granularity='none'):
+        """Trade recompute for activation memory during training.
+
+        'block' checkpoints every encoder/bottleneck/decoder level and every refinement
+        down block and CFF block; 'stage' checkpoints the encoder, the shared bottleneck,
+        the coarse decoder and the refinement stage as a whole; 'none' disables it.
+        """
+        if granularity not in ('none', 'block', 'stage'):
+            raise TypeError("Unknown checkpoint granularity:\t{}".format(granularity))
+        self.grad_ckpt_stage = granularity == 'stage'
+        stages = [self.encoder, self.shared_decoder, self.coarse_decoder, self.refinement]
+        for stage in stages:
+            if stage is not None:
+                getattr(stage, 'module', stage).grad_ckpt = granularity == 'block'
+
     def set_optimizers(self):
         self.optimizer_encoder = torch.optim.Adam(self.encoder.parameters(), lr=self.args.lr)
         self.optimizer_image = torch.optim.Adam(self.coarse_decoder.parameters(), lr=self.args.lr)
@@ -302,13 +390,16 @@ class SLBR(nn.Module):
         if self.refinement is not None:
             self.optimizer_refine.zero_grad()
 
-    def step_all(self):
-        self.optimizer_encoder.step()
+    def step_all(self, scaler=None):
+        # with a GradScaler every optimizer is unscaled and stepped (or skipped on inf/nan) by the scaler;
+        # the caller runs scaler.update() once after all of them
+        step = scaler.step if scaler is not None else lambda optimizer: optimizer.step()
+        step(self.optimizer_encoder)
         if self.shared != 0:
-               self.optimizer_shared.step()
-        self.optimizer_image.step()
+               step(self.optimizer_shared)
+        step(self.optimizer_image)
         if self.refinement is not None:
-            self.optimizer_refine.step()
+            step(self.optimizer_refine)
 
     def multi_gpu(self):
         self.encoder = nn.DataParallel(self.encoder, device_ids=range(torch.cuda.device_count()))
@@ -318,12 +409,62 @@ class SLBR(nn.Module):
             self.refinement = nn.DataParallel(self.refinement, device_ids=range(torch.cuda.device_count()))
         return
 
-    def forward(self, synthesized):
+    def distributed(self, device_ids=None):
+        # one DDP wrapper per stage, like multi_gpu; BN running stats stay per process so that
+        # evaluating on rank 0 alone does not wait on a buffer broadcast.
+        # the SMR refine_branch never receives a gradient, hence find_unused_parameters on the decoder
+        ddp = lambda m, unused=False: nn.parallel.DistributedDataParallel(m, device_ids=device_ids,
+                                                                        broadcast_buffers=False,
+                                                                        find_unused_parameters=unused)
+        if any(p.requires_grad for p in self.encoder.parameters()):
+            # a frozen encoder (--feat_cache) has no gradients to reduce
+            self.encoder = ddp(self.encoder)
+        self.shared_decoder = ddp(self.shared_decoder)
+        self.coarse_decoder = ddp(self.coarse_decoder, unused=True)
+        if self.refinement is not None:
+            self.refinement = ddp(self.refinement)
+        return
+
+    @contextlib.contextmanager
+    def no_sync(self):
+        """Skip the DDP gradient all-reduce of every stage (gradient accumulation micro-batches)."""
+        with contextlib.ExitStack() as stack:
+            for stage in [self.encoder, self.shared_decoder, self.coarse_decoder, self.refinement]:
+                if isinstance(stage, nn.parallel.DistributedDataParallel):
+                    stack.enter_context(stage.no_sync())
+            yield
+
+    def detect(self, synthesized):
+        """Predict the watermark masks only.
+
+        Runs the encoder, the mask half of the shared bottleneck and the SMR blocks;
+        the background decoder and the refinement stage are skipped.
+        Returns the mask list in the same layout as the second output of forward.
+        """
+        synthesized = synthesized.contiguous(memory_format=self.memory_format)
         image_code, before_pool = self.encoder(synthesized)
+        # DataParallel/DDP wrappers only expose forward
+        shared_decoder = getattr(self.shared_decoder, 'module', self.shared_decoder)
+        coarse_decoder = getattr(self.coarse_decoder, 'module', self.coarse_decoder)
+        mask = shared_decoder.forward_mask(image_code)
+        return coarse_decoder.forward_mask(mask, before_pool)
+
+    def forward(self, synthesized):
+        synthesized = synthesized.contiguous(memory_format=self.memory_format)
+        image_code, before_pool = self.encode(synthesized)
+        return self.decode(synthesized, image_code, before_pool)
+
+    def encode(self, synthesized):
+        """CoarseEncoder output: the image code and the skip tensors of every level."""
+        return maybe_checkpoint(self.grad_ckpt_stage, self.encoder, synthesized)
+
+    def decode(self, synthesized, image_code, before_pool):
+        """Everything after the encoder, from its outputs (possibly cached, see FeatureCacheDataset)."""
+        ckpt = self.grad_ckpt_stage
         unshared_before_pool = before_pool #[: - self.shared]
 
-        im, mask = self.shared_decoder(image_code)
-        ims, mask, wm = self.coarse_decoder(im, None, mask, unshared_before_pool)
+        im, mask = maybe_checkpoint(ckpt, self.shared_decoder, image_code)
+        ims, mask, wm = maybe_checkpoint(ckpt, self.coarse_decoder, im, None, mask, unshared_before_pool)
         im = ims[0]
         reconstructed_image = torch.tanh(im)
         if self.long_skip:
@@ -335,7 +476,7 @@ class SLBR(nn.Module):
         if self.refinement is not None:
             dec_feats = (ims)[1:][::-1]
             coarser = reconstructed_image * reconstructed_mask + (1-reconstructed_mask)* synthesized
-            refine_bg = self.refinement(synthesized, coarser, reconstructed_mask, None, dec_feats)
+            refine_bg = maybe_checkpoint(ckpt, self.refinement, synthesized, coarser, reconstructed_mask, None, dec_feats)
             refine_bg = (torch.tanh(refine_bg) + synthesized).clamp(0,1) # coarser
             return [refine_bg, reconstructed_image], mask, [reconstructed_wm]
         
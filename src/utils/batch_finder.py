@@ -0,0 +1,222 @@
+"""Find the largest batch (or input size) that fits in a memory budget and remember it per machine.
+
+Every trial runs in a fresh process: a real out-of-memory error (or the kernel OOM
+killer on CPU) only ends that trial, and the peak memory of one trial does not carry
+over into the next. The peak is the CUDA allocator's reserved memory on a GPU and the
+process' maximum RSS on CPU.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import traceback
+
+import torch
+
+CONFIG_PATH = os.path.expanduser('~/.cache/slbr/batch_config.json')
+SIZE_STEP = 32 # the encoder halves the input four times
+
+
+def machine_key():
+    device = torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'cpu'
+    return '%s/%s' % (socket.gethostname(), device)
+
+
+def default_size(args, mode):
+    """Input size of the training loader (as build_train_loader) or of the predictor."""
+    if mode == 'train' and args.preprocess != 'resize_and_crop':
+        return args.input_size
+    return args.crop_size
+
+
+def setting_key(args, mode, size):
+    """Everything besides the batch that changes the memory of a step."""
+    key = '%s:%s:f%d:r%d:%s:s%d:k%d:ckpt-%s:amp-%s:cl%d:mp%d' % (
+        mode, args.nets, args.start_filters, args.k_refine, 'refine' if args.use_refine else 'norefine',
+        args.k_skip_stage, args.k_center, args.grad_ckpt, args.amp, int(args.channels_last),
+        int(args.mask_pyramid))
+    if mode == 'train':
+        # the perceptual loss, a distillation teacher and the EMA copy only exist in training
+        key += ':vgg%d-%d:ema%d' % (args.lambda_content > 0, args.lambda_style > 0, args.ema > 0)
+        if args.teacher != '':
+            key += ':teacher-%s-f%d-r%d' % (os.path.basename(args.teacher), args.teacher_start_filters, args.teacher_k_refine)
+    return '%s:%dpx' % (key, size)
+
+
+def memory_budget(mb=0):
+    """Budget in bytes: mb megabytes, or 90% of the GPU (80% of the RAM on CPU)."""
+    if mb > 0:
+        return int(mb * 2 ** 20)
+    if torch.cuda.is_available():
+        return int(0.9 * torch.cuda.get_device_properties(0).total_memory)
+    return int(0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+
+
+def run_step(args, mode, batch, size):
+    """Build the network from args and run one training step (two, so the Adam states exist) or inference forward."""
+    import src.networks as nets
+    from src.models.SLBR import Distiller, Losses
+    from src.utils.ema import ModelEMA
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    net = nets.__dict__[args.nets](args=args).to(device)
+    x = torch.rand(batch, 3, size, size, device=device)
+    amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.amp)
+    autocast = lambda: torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+    if mode == 'infer':
+        net.eval()
+        with torch.no_grad(), autocast():
+            net(x)
+        return device
+
+    net.set_optimizers()
+    identity = lambda t: t
+    # same memory without the pretrained VGG weights (and their download)
+    losses = Losses(args, device, identity, identity, pretrained=False)
+    distiller, ema = None, None
+    if args.teacher != '':
+        distiller = Distiller(args, net, device)
+        optimizer_kd = torch.optim.Adam(distiller.adapters.parameters(), lr=args.lr)
+    if args.ema > 0:
+        ema = ModelEMA(nets.__dict__[args.nets](args=args).to(device), net, decay=args.ema)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == 'fp16')
+    target, mask = torch.rand_like(x), (torch.rand(batch, 1, size, size, device=device) > 0.8).float()
+    net.train()
+    for _ in range(2):
+        net.zero_grad_all()
+        if distiller is not None:
+            optimizer_kd.zero_grad()
+        with autocast():
+            outputs = net(x)
+            coarse_loss, refine_loss, style_loss, mask_loss = losses(x, outputs[0], target, outputs[1], mask)
+            total_loss = args.lambda_l1*(coarse_loss+refine_loss) + args.lambda_mask * (mask_loss) + style_loss
+            if distiller is not None:
+                total_loss = total_loss + distiller(x, outputs)
+        scaler.scale(total_loss).backward()
+        net.step_all(scaler)
+        if distiller is not None:
+            scaler.step(optimizer_kd)
+        scaler.update()
+        if ema is not None:
+            ema.update()
+        del outputs
+    return device
+
+
+def _trial(args, mode, batch, size, conn):
+    try:
+        device = run_step(args, mode, batch, size)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_reserved()
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KiB on Linux
+        conn.send(('ok', peak))
+    except Exception as e:
+        oom = isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)) or \
+              'out of memory' in str(e) or "can't allocate memory" in str(e)
+        conn.send(('oom', str(e)) if oom else ('error', traceback.format_exc()))
+
+
+def measure(args, mode, batch, size):
+    """Peak memory in bytes of one step in a fresh process, None if it ran out of memory."""
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_trial, args=(args, mode, batch, size, child))
+    process.start()
+    child.close()
+    result = parent.recv() if parent.poll(None) else None
+    process.join()
+    if result is None:
+        if process.exitcode != 0:
+            # killed by the OOM killer or crashed before reporting
+            return None
+        raise RuntimeError('trial with batch %d at %dpx did not report' % (batch, size))
+    if result[0] == 'error':
+        raise RuntimeError('trial with batch %d at %dpx failed:\n%s' % (batch, size, result[1]))
+    return result[1] if result[0] == 'ok' else None
+
+
+def search(fits, low, high):
+    """Largest n in [low, high] with fits(n), assuming fits is monotone; low - 1 if none.
+
+    The upper end is found by doubling from low, then bisected.
+    """
+    good, bad = low - 1, high + 1
+    n = low
+    while n <= high:
+        if not fits(n):
+            bad = n
+            break
+        good = n
+        n = min(n * 2, high) if n < high else high + 1
+    while bad - good > 1:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    return good
+
+
+def find_max_batch(args, mode='train', size=None, budget=None, max_batch=512, verbose=True):
+    """Largest batch whose step fits in budget bytes at input size; returns (batch, peak bytes)."""
+    size = size or default_size(args, mode)
+    budget = budget or memory_budget()
+    peaks = {}
+
+    def fits(batch):
+        peaks[batch] = measure(args, mode, batch, size)
+        ok = peaks[batch] is not None and peaks[batch] <= budget
+        if verbose:
+            print('==> %s batch %4d at %dpx: %s' % (mode, batch, size,
+                  'out of memory' if peaks[batch] is None else '%.0f MB%s' % (peaks[batch] / 2 ** 20, '' if ok else ' (over budget)')))
+        return ok
+
+    batch = search(fits, 1, max_batch)
+    return batch, peaks.get(batch)
+
+
+def find_max_size(args, mode='train', batch=1, budget=None, max_size=2048, verbose=True):
+    """Largest input size (a multiple of 32) whose step with batch fits in budget bytes; returns (size, peak bytes)."""
+    budget = budget or memory_budget()
+    peaks = {}
+
+    def fits(steps):
+        size = steps * SIZE_STEP
+        peaks[size] = measure(args, mode, batch, size)
+        ok = peaks[size] is not None and peaks[size] <= budget
+        if verbose:
+            print('==> %s batch %d at %4dpx: %s' % (mode, batch, size,
+                  'out of memory' if peaks[size] is None else '%.0f MB%s' % (peaks[size] / 2 ** 20, '' if ok else ' (over budget)')))
+        return ok
+
+    size = search(fits, 1, max_size // SIZE_STEP) * SIZE_STEP
+    return size, peaks.get(size)
+
+
+def load_config(path=None):
+    path = path or CONFIG_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_result(key, result, path=None):
+    """Store result under this machine and key (atomically, other entries are kept)."""
+    path = path or CONFIG_PATH
+    config = load_config(path)
+    config.setdefault(machine_key(), {})[key] = result
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def lookup_batch(args, mode, size=None, path=None):
+    """The batch find_batch.py stored for this machine and these options, None if there is none."""
+    size = size or default_size(args, mode)
+    entry = load_config(path).get(machine_key(), {}).get(setting_key(args, mode, size))
+    return entry['batch'] if entry is not None else None
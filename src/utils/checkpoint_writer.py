@@ -0,0 +1,108 @@
+"""Write checkpoints from a background thread so training only pays for a copy to host memory."""
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+
+def to_cpu(obj):
+    """Deep copy of a (nested) checkpoint with every tensor cloned to CPU memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(state, path):
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def atomic_link(src, dst):
+    """Point dst at the finished file src: a hard link when possible, a copy otherwise."""
+    try:
+        if os.path.exists(dst + '.tmp'):
+            os.remove(dst + '.tmp')
+        os.link(src, dst + '.tmp')
+    except OSError:
+        shutil.copyfile(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+
+class CheckpointWriter(object):
+    """Save checkpoints in a background thread, atomically (temp file + rename).
+
+    save() snapshots the state to CPU and returns; the thread writes
+    checkpoint_step_<step>.pth.tar, points checkpoint.pth.tar (and model_best.pth.tar
+    for a best one) at it and deletes the step files beyond the last keep. With keep=0
+    only checkpoint.pth.tar is written. A crash mid-write leaves the previous files intact.
+    """
+    def __init__(self, directory, keep=0, max_pending=1):
+        self.directory = directory
+        self.keep = keep
+        # step files of an earlier (resumed) run count towards keep
+        steps = sorted(int(f[len('checkpoint_step_'):-len('.pth.tar')]) for f in os.listdir(directory)
+                       if re.match(r'checkpoint_step_\d+\.pth\.tar$', f))
+        self.history = [os.path.join(directory, 'checkpoint_step_{}.pth.tar'.format(step)) for step in steps]
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, step, filename='checkpoint.pth.tar', is_best=False, snapshot=None, callback=None):
+        """Queue state for writing; blocks only while max_pending saves are already waiting.
+
+        snapshot: also keep a copy under this name (outside the retention policy).
+        callback(path): called from the writer thread once the file is complete.
+        """
+        if self.error is not None:
+            raise RuntimeError('checkpoint writer failed') from self.error
+        self.queue.put((to_cpu(state), step, filename, is_best, snapshot, callback))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                self.write(*job)
+            except Exception as e:
+                print('==> checkpoint writer error: %s' % e)
+                self.error = e
+            self.queue.task_done()
+
+    def write(self, state, step, filename, is_best, snapshot, callback):
+        latest = os.path.join(self.directory, filename)
+        if self.keep > 0:
+            path = os.path.join(self.directory, 'checkpoint_step_{}.pth.tar'.format(step))
+            atomic_save(state, path)
+            atomic_link(path, latest)
+            if path in self.history:
+                self.history.remove(path)
+            self.history.append(path)
+            while len(self.history) > self.keep:
+                os.remove(self.history.pop(0))
+        else:
+            atomic_save(state, latest)
+        if snapshot:
+            atomic_link(latest, os.path.join(self.directory, snapshot))
+        if is_best:
+            print('Saving Best Metric with PSNR:%s' % state['best_acc'])
+            atomic_link(latest, os.path.join(self.directory, 'model_best.pth.tar'))
+        if callback is not None:
+            callback(latest)
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
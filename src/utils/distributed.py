@@ -0,0 +1,67 @@
+"""Helpers for torchrun-launched DistributedDataParallel training.
+
+torchrun exports RANK, WORLD_SIZE and LOCAL_RANK; without them training runs in a
+single process exactly as before.
+"""
+import os
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """Join the process group when launched by torchrun and fill the args.rank/world_size fields."""
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.distributed = args.world_size > 1
+    if not args.distributed:
+        return args
+
+    backend = args.dist_backend
+    if backend == '':
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.local_rank)
+    dist.init_process_group(backend=backend)
+    print('==> rank %d/%d (local %d) joined the %s process group' % (args.rank, args.world_size, args.local_rank, backend))
+    return args
+
+
+def cleanup_distributed(args):
+    if getattr(args, 'distributed', False):
+        dist.destroy_process_group()
+
+
+def is_main_process(args):
+    return getattr(args, 'rank', 0) == 0
+
+
+def barrier(args):
+    if getattr(args, 'distributed', False):
+        dist.barrier()
+
+
+def all_reduce_grads(params, args):
+    """Average the gradients of parameters that live outside a DDP wrapper."""
+    if not getattr(args, 'distributed', False):
+        return
+    for p in params:
+        if p.grad is not None:
+            dist.all_reduce(p.grad)
+            p.grad /= args.world_size
+
+
+def strip_ddp_prefix(state_dict):
+    """State dict of DDP-wrapped sub-modules in the plain (single process) key layout."""
+    return OrderedDict((k.replace('.module.', '.'), v) for k, v in state_dict.items())
+
+
+def any_process(flag, args, device):
+    """True on every rank if flag is set on any of them (one all_reduce under torchrun)."""
+    if not getattr(args, 'distributed', False):
+        return flag
+    flag = torch.tensor([1 if flag else 0], device=device)
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
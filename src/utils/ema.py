@@ -0,0 +1,72 @@
+"""Exponential moving average of the network weights."""
+import torch
+
+from .distributed import strip_ddp_prefix
+
+
+class ModelEMA(object):
+    """Keep ema_net at the exponential moving average of model's parameters.
+
+    update() is called after every optimizer step and averages in every `every`-th one
+    with the decay raised to that power, so the averaging horizon does not depend on
+    `every`; early updates use a smaller decay ((1 + n) / (10 + n)) so the average is
+    not dominated by the initial weights. Buffers
+    (BatchNorm statistics) are copied. On a GPU the update is queued on a side stream;
+    wait() makes the current stream wait for it (no host sync) and has to be called
+    before the model parameters are changed again or the average is read.
+    """
+    def __init__(self, ema_net, model, decay=0.999, every=1):
+        self.module = ema_net
+        # wrapped stages (DataParallel) are matched by their plain names
+        self.module.load_state_dict(strip_ddp_prefix(model.state_dict()))
+        self.module.eval()
+        for p in self.module.parameters():
+            p.requires_grad = False
+        self.decay = decay
+        self.every = max(1, every)
+        self.steps, self.updates = 0, 0
+        # the DDP wrappers and torch.compile applied later keep these parameter objects
+        model_params = strip_ddp_prefix(dict(model.named_parameters()))
+        model_buffers = strip_ddp_prefix(dict(model.named_buffers()))
+        self.params = [(p, model_params[name]) for name, p in self.module.named_parameters()]
+        self.buffers = [(b, model_buffers[name]) for name, b in self.module.named_buffers()]
+        device = self.params[0][0].device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.event = torch.cuda.Event() if self.stream is not None else None
+
+    @torch.no_grad()
+    def apply(self, decay):
+        ema_params = [p for p, _ in self.params]
+        torch._foreach_lerp_(ema_params, [p.detach() for _, p in self.params], 1 - decay)
+        for b, model_b in self.buffers:
+            b.copy_(model_b)
+
+    def update(self):
+        """Called after an optimizer step; averages in the current weights every `every` steps."""
+        self.steps += 1
+        if self.steps % self.every != 0:
+            return
+        self.updates += 1
+        decay = min(self.decay ** self.every, (1 + self.updates) / (10 + self.updates))
+        if self.stream is None:
+            self.apply(decay)
+            return
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.apply(decay)
+        self.event.record(self.stream)
+
+    def wait(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_event(self.event)
+
+    def counters(self):
+        return {'steps': self.steps, 'updates': self.updates}
+
+    def load_state_dict(self, counters):
+        """Restore the step counters (the weights are the checkpoint state_dict)."""
+        self.steps, self.updates = counters['steps'], counters['updates']
+
+    def state_dict(self):
+        self.wait()
+        return self.module.state_dict()
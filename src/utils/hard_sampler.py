@@ -0,0 +1,96 @@
+"""Loss-aware sampling: draw the samples the model still gets wrong more often."""
+import math
+
+import torch
+import torch.distributed as dist
+
+from .train_state import ResumableSampler
+
+
+class HardExampleSampler(ResumableSampler):
+    """ResumableSampler drawing each epoch with replacement, in proportion to the last training losses.
+
+    update() records the per-sample losses of a batch on the training device (no host
+    sync); the next epoch draws sample i with probability proportional to
+    (score_i / mean score) ** (1 / temperature), so temperature 1 samples in proportion to
+    the loss and a large one is close to uniform. Scores not refreshed during an epoch are
+    pulled towards the mean by decay, so a sample seen once with a low loss is not starved
+    forever. Samples without a score yet count as the hardest ones; the first epoch is a
+    plain shuffle. The drawn order is kept in the state so an interrupted epoch continues
+    with the same samples.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0, temperature=1.0, decay=0.5):
+        super(HardExampleSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.temperature = temperature
+        self.decay = decay
+        n = len(dataset)
+        self.scores = torch.zeros(n)
+        self.seen = torch.zeros(n, dtype=torch.bool)
+        self.updated = torch.zeros(n, dtype=torch.bool) # refreshed during the current epoch
+        self.order, self.order_epoch = None, -1
+
+    def update(self, indices, losses):
+        """Record the (detached) per-sample losses of a batch."""
+        if self.scores.device != losses.device:
+            self.scores, self.seen, self.updated = [t.to(losses.device) for t in (self.scores, self.seen, self.updated)]
+        indices = indices.to(losses.device, non_blocking=True)
+        self.scores[indices] = losses.detach().float()
+        self.seen[indices] = True
+        self.updated[indices] = True
+
+    def sync(self, args):
+        """Merge the scores of all ranks (every rank has to call it, e.g. before a checkpoint)."""
+        if not getattr(args, 'distributed', False):
+            return
+        updated = self.updated.float()
+        merged = torch.stack([self.scores * updated, updated])
+        dist.all_reduce(merged)
+        self.updated = merged[1] > 0
+        self.scores = torch.where(self.updated, merged[0] / merged[1].clamp(min=1), self.scores)
+        self.seen |= self.updated
+
+    def weights(self):
+        """Sampling weights of the next epoch; decays the scores that were not refreshed."""
+        scores, seen, updated = self.scores.cpu().double(), self.seen.cpu(), self.updated.cpu()
+        if not seen.any():
+            return None
+        mean = scores[seen].mean()
+        stale = seen & ~updated
+        scores[stale] = mean + self.decay * (scores[stale] - mean)
+        self.scores = scores.float().to(self.scores.device)
+        self.updated = torch.zeros_like(self.updated)
+        scores = torch.where(seen, scores, scores[seen].max())
+        return (scores / max(mean.item(), 1e-12)).clamp(min=1e-6) ** (1.0 / self.temperature)
+
+    def __iter__(self):
+        if self.order is None or self.order_epoch != self.epoch:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            weights = self.weights()
+            if weights is None:
+                order = torch.randperm(len(self.dataset), generator=g)
+                order = order.repeat(math.ceil(self.total_size / len(order)))[:self.total_size]
+            else:
+                order = torch.multinomial(weights, self.total_size, replacement=True, generator=g)
+            # the same list on every rank, each takes its slice
+            self.order, self.order_epoch = order.tolist(), self.epoch
+        indices = self.order[self.rank:self.total_size:self.num_replicas][self.start:]
+        self.start = 0
+        return iter(indices)
+
+    def state_dict(self):
+        return {
+            'scores': self.scores.cpu(),
+            'seen': self.seen.cpu(),
+            'updated': self.updated.cpu(),
+            'order': torch.tensor(self.order if self.order is not None else [], dtype=torch.long),
+            'order_epoch': self.order_epoch if self.order is not None else -1,
+        }
+
+    def load_state_dict(self, state):
+        if state['scores'].numel() != len(self.scores):
+            print('==> hard example scores are for %d samples, not %d; starting afresh' % (state['scores'].numel(), len(self.scores)))
+            return
+        self.scores, self.seen, self.updated = state['scores'].float(), state['seen'].bool(), state['updated'].bool()
+        self.order = state['order'].tolist() if state['order_epoch'] >= 0 else None
+        self.order_epoch = state['order_epoch']
@@ -50,16 +50,32 @@ class WeightedBCE(nn.Module):
 
 def l1_relative(reconstructed, real, mask):
     batch = real.size(0)
-    area = torch.sum(mask.view(batch,-1),dim=1)
+    area = torch.sum(mask.reshape(batch,-1),dim=1)
     reconstructed = reconstructed * mask
     real = real * mask
     
-    loss_l1 = torch.abs(reconstructed - real).view(batch, -1)
+    loss_l1 = torch.abs(reconstructed - real).reshape(batch, -1)
     loss_l1 = torch.sum(loss_l1, dim=1) / (area+1e-6)
     loss_l1 = torch.sum(loss_l1) / batch
     return loss_l1
 
 
+def mask_pyramid(mask, sizes):
+    """The mask area-pooled to every (h, w) in sizes, as a dict; each level is pooled from the
+    smallest finer one that it divides, so the full mask is read once per scale chain."""
+    levels = {tuple(mask.shape[2:]): mask}
+    for size in sorted(set(sizes), reverse=True):
+        if size in levels:
+            continue
+        finer = [s for s in levels if s[0] % size[0] == 0 and s[1] % size[1] == 0]
+        if finer:
+            source = levels[min(finer)]
+            levels[size] = F.avg_pool2d(source, (source.shape[2] // size[0], source.shape[3] // size[1]))
+        else:
+            levels[size] = F.adaptive_avg_pool2d(mask, size)
+    return levels
+
+
 def is_dic(x):
     return type(x) == type([])
 
@@ -156,13 +172,13 @@ class MeanShift(nn.Conv2d):
 
 
 
-def VGGLoss(losstype, style=False):
+def VGGLoss(losstype, style=False, pretrained=True):
     if losstype == 'vggx':
-        return VGGLossX(mask=False, style=style)
+        return VGGLossX(mask=False, style=style, pretrained=pretrained)
     elif losstype == 'mvggx':
-        return VGGLossX(mask=True)
+        return VGGLossX(mask=True, pretrained=pretrained)
     elif losstype == 'rvggx':
-        return VGGLossX(mask=True,relative=True)
+        return VGGLossX(mask=True,relative=True, pretrained=pretrained)
     else:
         raise Exception("error in %s"%losstype)
 
@@ -171,9 +187,9 @@ def VGGLoss(losstype, style=False):
 
 
 class VGG16FeatureExtractor(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super().__init__()
-        vgg16 = models.vgg16(pretrained=True)
+        vgg16 = models.vgg16(pretrained=pretrained)
         self.enc_1 = nn.Sequential(*vgg16.features[:5])
         self.enc_2 = nn.Sequential(*vgg16.features[5:10])
         self.enc_3 = nn.Sequential(*vgg16.features[10:17])
@@ -191,49 +207,63 @@ class VGG16FeatureExtractor(nn.Module):
         return results[1:]
 
 class VGGLossX(nn.Module):
-    def __init__(self, normalize=True, mask=False, relative=False, style=False):
+    def __init__(self, normalize=True, mask=False, relative=False, style=False, pretrained=True):
         super(VGGLossX, self).__init__()
         
-        self.vgg = VGG16FeatureExtractor().cuda()
-        self.criterion = nn.L1Loss().cuda() if not relative else l1_relative
+        self.vgg = VGG16FeatureExtractor(pretrained)
+        self.criterion = nn.L1Loss() if not relative else l1_relative
         self.use_style = style
         self.use_mask= mask
         self.relative = relative
 
         if normalize:
-            self.normalize = MeanShift([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], norm=True).cuda()
+            self.normalize = MeanShift([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], norm=True)
         else:
             self.normalize = None
 
-    def forward(self, x, y, Xmask=None):
-        if not self.use_mask:
-            mask = torch.ones_like(x)[:,0:1,:,:]
-        else:
-            mask = Xmask
+    def target_features(self, y, Xmask=None):
+        """VGG features, feature-size masks and Gram matrices of the target.
+
+        They do not depend on the prediction, so Losses computes them once per batch
+        and passes them to every forward call of the batch.
+        """
+        with torch.no_grad():
+            if not self.use_mask:
+                mask = torch.ones_like(y)[:,0:1,:,:]
+            else:
+                mask = Xmask
+            if self.normalize is not None:
+                y = self.normalize(y)
+            y_vgg = self.vgg(y)
+            masks = [resize_to_match(mask,y_vgg[i]) for i in range(3)]
+            if self.relative:
+                feats = y_vgg
+            else:
+                feats = [masks[i]*y_vgg[i] for i in range(3)]
+            grams = [self.gram_matrix(y_vgg[i]) for i in range(3)] if self.use_style else None
+        return {"feats":feats, "masks":masks, "grams":grams}
+
+    def forward(self, x, y, Xmask=None, target=None):
+        if target is None:
+            target = self.target_features(y, Xmask)
 
-        x0 = x
-        y0 = y
         if self.normalize is not None:
             x = self.normalize(x)
-            y = self.normalize(y)
 
         x_vgg = self.vgg(x)
-        y_vgg = self.vgg(y)
-        # self.visualize([x0]+x_vgg, [y0]+y_vgg)
         loss = 0
         style_loss = 0
         for i in range(3):
             # VGG Content Loss
             if self.relative:
-                loss += self.criterion(x_vgg[i],y_vgg[i].detach(),resize_to_match(mask,x_vgg[i]))
+                loss += self.criterion(x_vgg[i],target['feats'][i],target['masks'][i])
             else:
-                loss += self.criterion(resize_to_match(mask,x_vgg[i])*x_vgg[i],resize_to_match(mask,y_vgg[i])*y_vgg[i].detach()) # 
+                loss += self.criterion(target['masks'][i]*x_vgg[i],target['feats'][i]) # 
                 # loss += self.criterion(x_vgg[i], y_vgg[i].detach())
             # VGG Style Loss
             if self.use_style:
                 x_gram = self.gram_matrix(x_vgg[i])
-                y_gram = self.gram_matrix(y_vgg[i].detach())
-                style_loss += F.l1_loss(x_gram, y_gram)
+                style_loss += F.l1_loss(x_gram, target['grams'][i])
 
         return {"content":loss, "style":style_loss}
 
@@ -241,7 +271,7 @@ class VGGLossX(nn.Module):
     def gram_matrix(self, feat):
         # https://github.com/pytorch/examples/blob/master/fast_neural_style/neural_style/utils.py
         (b, ch, h, w) = feat.size()
-        feat = feat.view(b, ch, h * w)
+        feat = feat.reshape(b, ch, h * w)
         feat_t = feat.transpose(1, 2)
         gram = torch.bmm(feat, feat_t) / (ch * h * w)
         return gram
@@ -58,6 +58,26 @@ def save_checkpoint(machine,filename='checkpoint.pth.tar', snapshot=None):
         
 
 
+def parse_res_schedule(spec):
+    """'0:256,10:384,20:512' -> [(0, 256), (10, 384), (20, 512)], sorted by epoch."""
+    if spec == '':
+        return []
+    schedule = []
+    for item in spec.split(','):
+        epoch, size = item.split(':')
+        schedule.append((int(epoch), int(size)))
+    return sorted(schedule)
+
+
+def resolution_at(schedule, epoch):
+    """Training resolution of an epoch, None before the first stage (the --crop_size/--input-size one)."""
+    size = None
+    for start, stage_size in schedule:
+        if epoch >= start:
+            size = stage_size
+    return size
+
+
 def save_pred(preds, checkpoint='checkpoint', filename='preds_valid.mat'):
     preds = to_numpy(preds)
     filepath = os.path.join(checkpoint, filename)
@@ -0,0 +1,440 @@
+"""Structured channel pruning for the SLBR network.
+
+Channels are grouped into "channel spaces": every conv/norm output that is added,
+concatenated or residually merged with another tensor shares the same space, so a
+space can only be pruned as a whole. ``build_groups`` walks the SLBR structure and
+returns these spaces, ``prune_model`` physically removes the least important
+channels of every space, and ``apply_prune_spec`` rebuilds the pruned shapes from a
+checkpoint so the weights can be loaded back.
+"""
+import copy
+import math
+
+import torch
+import torch.nn as nn
+
+
+class ChannelGroup(object):
+    """A set of conv/norm dims sharing one channel index space.
+
+    producers: (module, dst_offset, lo, hi) whose output dims hold channels [lo, hi)
+    consumers: (conv, dst_offset, lo, hi) whose input dims read channels [lo, hi)
+    split:     number of equal sub-ranges that must keep the same channel count
+               (MBEBlock splits its features into two halves)
+    """
+    def __init__(self, name, size, split=1):
+        self.name = name
+        self.size = size
+        self.split = split
+        self.producers = []
+        self.consumers = []
+
+    def produce(self, module, dst_offset=0, lo=0, hi=None):
+        self.producers.append((module, dst_offset, lo, self.size if hi is None else hi))
+
+    def consume(self, module, dst_offset=0, lo=0, hi=None):
+        self.consumers.append((module, dst_offset, lo, self.size if hi is None else hi))
+
+
+def _unwrap(m):
+    return m.module if isinstance(m, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else m
+
+
+def _conv_group(name, conv):
+    g = ChannelGroup(name, conv.out_channels)
+    g.produce(conv)
+    return g
+
+
+def _down_conv_group(name, dc):
+    g = ChannelGroup(name, dc.conv1.out_channels)
+    g.produce(dc.conv1)
+    g.produce(dc.norm1)
+    for conv, bn in zip(dc.conv2, dc.bn):
+        g.produce(conv)
+        g.produce(bn)
+        g.consume(conv)
+    return g
+
+
+def _up_conv_groups(name, uc):
+    """UpConv has two spaces: the upsampled input and the fused output."""
+    up = ChannelGroup(name + '.up', uc.conv1.out_channels)
+    up.produce(uc.up_conv[1])
+    up.produce(uc.norm0)
+    up.consume(uc.conv1, 0)
+
+    g = ChannelGroup(name, uc.conv1.out_channels)
+    g.produce(uc.conv1)
+    g.produce(uc.norm1)
+    for conv, bn in zip(uc.conv2, uc.bn):
+        g.produce(conv)
+        g.produce(bn)
+        g.consume(conv)
+    return up, g
+
+
+def _mbe_groups(name, mbe):
+    c = mbe.conv1.out_channels
+    up = ChannelGroup(name + '.up', c)
+    up.produce(mbe.up_conv[1])
+    up.produce(mbe.norm0)
+    up.consume(mbe.conv1, 0)
+
+    g = ChannelGroup(name, c, split=2)
+    g.produce(mbe.conv1)
+    g.produce(mbe.norm1)
+    hidden = []
+    for idx, (convs, conv3, bn) in enumerate(zip(mbe.conv2, mbe.conv3, mbe.bn)):
+        g.consume(convs[0], 0, 0, c // 2)
+        g.consume(conv3, 0, c // 2, c)
+        g.produce(conv3)
+        g.produce(bn)
+        h = _conv_group('%s.conv2.%d' % (name, idx), convs[0])
+        h.consume(convs[2])
+        hidden.append(h)
+    return [up, g] + hidden
+
+
+def _smr_groups(name, smr):
+    up, g = _up_conv_groups(name, smr.upconv)
+    c = g.size
+    g.consume(smr.primary_mask[0])
+    g.consume(smr.refine_branch[0])
+    att = smr.self_calibrated
+    for conv in (att.q_conv, att.k_conv, att.v_conv):
+        g.consume(conv)
+    # query, every key and every value chunk live in the feature space
+    g.produce(att.q_conv)
+    for k in range(att.k_center):
+        g.produce(att.k_conv, k * c)
+        g.produce(att.v_conv, k * c)
+    g.consume(att.sim_func, 0)
+    g.consume(att.sim_func, c)
+    g.consume(att.out_conv[0])
+
+    h = _conv_group(name + '.attn_out', att.out_conv[0])
+    h.consume(att.out_conv[2])
+    return [up, g, h]
+
+
+def _seq_hidden_group(name, seq):
+    # Conv -> act -> Conv
+    h = _conv_group(name, seq[0])
+    h.consume(seq[2])
+    return h
+
+
+def build_groups(net):
+    """Return the prunable channel groups of an SLBR network."""
+    groups = []
+    encoder = _unwrap(net.encoder)
+    shared = _unwrap(net.shared_decoder)
+    decoder = _unwrap(net.coarse_decoder)
+    refinement = _unwrap(net.refinement) if net.refinement is not None else None
+
+    # coarse encoder
+    enc = [_down_conv_group('encoder.%d' % i, dc) for i, dc in enumerate(encoder.down_convs)]
+    for i, g in enumerate(enc[:-1]):
+        g.consume(encoder.down_convs[i + 1].conv1)
+    enc[-1].consume(shared.down_convs[0].conv1)
+    groups += enc
+
+    # shared bottleneck
+    sb = [_down_conv_group('shared.down.%d' % i, dc) for i, dc in enumerate(shared.down_convs)]
+    for i, g in enumerate(sb[:-1]):
+        g.consume(shared.down_convs[i + 1].conv1)
+    sb_up = []
+    for i, uc in enumerate(shared.up_convs):
+        up, g = _up_conv_groups('shared.up.%d' % i, uc)
+        groups.append(up)
+        sb_up.append(g)
+        sb[-(i + 2)].consume(uc.conv1, g.size)
+    sb[-1].consume(shared.up_convs[0].up_conv[1])
+    for i, g in enumerate(sb_up[:-1]):
+        g.consume(shared.up_convs[i + 1].up_conv[1])
+    # both decoder branches start from the shared up-convs
+    sb_up[-1].consume(decoder.up_convs_bg[0].up_conv[1])
+    sb_up[-1].consume(decoder.up_convs_mask[0].upconv.up_conv[1])
+    groups += sb + sb_up
+
+    # coarse decoder
+    bg_main, mask_main = [], []
+    for j, (mbe, smr) in enumerate(zip(decoder.up_convs_bg, decoder.up_convs_mask)):
+        mbe_groups = _mbe_groups('decoder.bg.%d' % j, mbe)
+        smr_groups = _smr_groups('decoder.mask.%d' % j, smr)
+        groups += mbe_groups + smr_groups
+        bg_main.append(mbe_groups[1])
+        mask_main.append(smr_groups[1])
+        # skip connection from the encoder
+        skip = enc[-(j + 1)]
+        skip.consume(mbe.conv1, mbe_groups[1].size)
+        skip.consume(smr.upconv.conv1, smr_groups[1].size)
+    for j in range(len(bg_main) - 1):
+        bg_main[j].consume(decoder.up_convs_bg[j + 1].up_conv[1])
+        mask_main[j].consume(decoder.up_convs_mask[j + 1].upconv.up_conv[1])
+    bg_main[-1].consume(decoder.conv_final_bg)
+
+    if refinement is not None:
+        groups += _refinement_groups(refinement, bg_main)
+    return groups
+
+
+def _refinement_groups(ref, bg_main):
+    groups = []
+    # decoder features feeding the refinement stage, finest first
+    dec_convs = [ref.dec_conv2, ref.dec_conv3, ref.dec_conv4]
+    for k, seq in enumerate(dec_convs):
+        if len(bg_main) > k:
+            bg_main[-(k + 1)].consume(seq[0])
+    groups.append(_seq_hidden_group('refinement.dec_conv3', ref.dec_conv3))
+    groups.append(_seq_hidden_group('refinement.dec_conv4', ref.dec_conv4))
+
+    x0 = ChannelGroup('refinement.in', ref.conv_in[0].out_channels)
+    x0.produce(ref.conv_in[0])
+    x0.produce(ref.conv_in[1])
+    x0.produce(ref.dec_conv2[0])
+    x0.consume(ref.down1.model.conv1)
+
+    d1 = _down_conv_group('refinement.down1', ref.down1.model)
+    d2 = _down_conv_group('refinement.down2', ref.down2.model)
+    d3 = _down_conv_group('refinement.down3', ref.down3.model)
+    d1.produce(ref.dec_conv3[2])
+    d1.consume(ref.down2.model.conv1)
+    d2.produce(ref.dec_conv4[2])
+    d2.consume(ref.down3.model.conv1)
+    groups += [x0, d1, d2, d3]
+
+    xs = [d1, d2, d3]
+    for b, block in enumerate(ref.cff_blocks):
+        name = 'refinement.cff.%d' % b
+        x1, x2, x3 = xs
+        x1.produce(block.up31[0])
+        x1.consume(block.down1.model.conv1)
+        x2.consume(block.conv22[0])
+        x3.consume(block.conv33[0])
+        x3.consume(block.up32[0])
+        x3.consume(block.up31[0])
+
+        b1 = _down_conv_group(name + '.down1', block.down1.model)
+        b2 = _down_conv_group(name + '.down2', block.down2.model)
+        b3 = _down_conv_group(name + '.down3', block.down3.model)
+        b1.produce(block.conv22[2])
+        b1.produce(block.up32[0])
+        b1.consume(block.down2.model.conv1)
+        b2.produce(block.conv33[2])
+        b2.consume(block.down3.model.conv1)
+        groups += [b1, b2, b3,
+                   _seq_hidden_group(name + '.conv22', block.conv22),
+                   _seq_hidden_group(name + '.conv33', block.conv33)]
+        xs = [b1, b2, b3]
+
+    offset = 0
+    for g in xs:
+        g.consume(ref.out_conv[0], offset)
+        offset += g.size
+    out_hidden = ChannelGroup('refinement.out', ref.out_conv[0].out_channels)
+    out_hidden.produce(ref.out_conv[0])
+    out_hidden.produce(ref.out_conv[1])
+    out_hidden.consume(ref.out_conv[3])
+    groups.append(out_hidden)
+    return groups
+
+
+#################################################################
+#           Channel importance
+#################################################################
+
+def _is_affine_bn(m):
+    return isinstance(m, nn.BatchNorm2d) and m.affine
+
+
+def channel_importance(group, criterion='bn'):
+    """Per-channel importance of a group.
+
+    'bn' uses the BatchNorm scale |gamma| of the group and falls back to the L1 norm
+    of the producing filters when the group has no affine BatchNorm (InstanceNorm
+    blocks). 'taylor' uses the first-order Taylor term |w * dL/dw| summed over the
+    producers, so the gradients of a few batches must have been accumulated first.
+    """
+    score = torch.zeros(group.size)
+    bns = [p for p in group.producers if _is_affine_bn(p[0])]
+    if criterion == 'bn' and len(bns) == 0:
+        criterion = 'l1'
+
+    for module, dst, lo, hi in group.producers:
+        if isinstance(module, nn.Conv2d):
+            w = module.weight.detach()[dst:dst + hi - lo]
+            if criterion == 'l1':
+                s = w.abs().flatten(1).mean(dim=1)
+            elif criterion == 'taylor':
+                if module.weight.grad is None:
+                    continue
+                g = module.weight.grad.detach()[dst:dst + hi - lo]
+                s = (w * g).flatten(1).sum(dim=1).abs()
+            else:
+                continue
+        elif _is_affine_bn(module):
+            w = module.weight.detach()[dst:dst + hi - lo]
+            if criterion == 'bn':
+                s = w.abs()
+            elif criterion == 'taylor' and module.weight.grad is not None:
+                s = (w * module.weight.grad.detach()[dst:dst + hi - lo]).abs()
+            else:
+                continue
+        else:
+            continue
+        score[lo:hi] += s.float().cpu()
+    return score
+
+
+def select_channels(group, score, ratio, min_channels=4):
+    """Indices to keep after removing ``ratio`` of the group's channels."""
+    chunk = group.size // group.split
+    n_keep = int(math.ceil(chunk * (1 - ratio)))
+    n_keep = max(min(min_channels, chunk), min(n_keep, chunk))
+    keep = []
+    for s in range(group.split):
+        part = score[s * chunk:(s + 1) * chunk]
+        idx = torch.argsort(part, descending=True)[:n_keep]
+        keep.append(torch.sort(idx)[0] + s * chunk)
+    return torch.cat(keep)
+
+
+#################################################################
+#           Physical pruning
+#################################################################
+
+def _mark(masks, module, dim_size, dst, lo, hi, keep):
+    if module not in masks:
+        masks[module] = torch.ones(dim_size, dtype=torch.bool)
+    removed = torch.ones(hi - lo, dtype=torch.bool)
+    inside = keep[(keep >= lo) & (keep < hi)] - lo
+    removed[inside] = False
+    masks[module][dst:dst + hi - lo] &= ~removed
+
+
+def _resize_module(module, out_mask=None, in_mask=None):
+    if isinstance(module, nn.Conv2d):
+        w = module.weight.data
+        # keep the layout of the original weight (see SLBR.set_channels_last)
+        fmt = torch.channels_last if w.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+        if out_mask is not None:
+            w = w[out_mask]
+            if module.bias is not None:
+                module.bias.data = module.bias.data[out_mask].clone()
+            module.out_channels = w.shape[0]
+        if in_mask is not None:
+            w = w[:, in_mask]
+            module.in_channels = w.shape[1]
+        module.weight.data = w.clone(memory_format=fmt)
+    elif isinstance(module, nn.modules.batchnorm._NormBase):
+        if out_mask is None:
+            return
+        if module.affine:
+            module.weight.data = module.weight.data[out_mask].clone()
+            module.bias.data = module.bias.data[out_mask].clone()
+        if module.running_mean is not None:
+            module.running_mean = module.running_mean[out_mask].clone()
+            module.running_var = module.running_var[out_mask].clone()
+        module.num_features = int(out_mask.sum())
+
+
+def _dim_size(module, which):
+    if isinstance(module, nn.Conv2d):
+        return module.out_channels if which == 'out' else module.in_channels
+    return module.num_features
+
+
+def apply_keep(groups, keeps):
+    """Remove every channel not listed in ``keeps[group.name]``.
+
+    Parameters are resized in place (``param.data``), so existing references such as
+    optimizers keep pointing at the same Parameter objects.
+    """
+    out_masks, in_masks = {}, {}
+    for g in groups:
+        keep = keeps.get(g.name)
+        if keep is None:
+            continue
+        for module, dst, lo, hi in g.producers:
+            _mark(out_masks, module, _dim_size(module, 'out'), dst, lo, hi, keep)
+        for module, dst, lo, hi in g.consumers:
+            _mark(in_masks, module, _dim_size(module, 'in'), dst, lo, hi, keep)
+    for module in set(out_masks) | set(in_masks):
+        _resize_module(module, out_masks.get(module), in_masks.get(module))
+
+
+def prune_model(net, ratio, criterion='bn', min_channels=4, scores=None):
+    """Prune ``ratio`` of the channels of every group; return the kept sizes."""
+    groups = build_groups(net)
+    keeps = {}
+    for g in groups:
+        score = scores[g.name] if scores is not None else channel_importance(g, criterion)
+        keeps[g.name] = select_channels(g, score, ratio, min_channels)
+    apply_keep(groups, keeps)
+    return {name: len(k) for name, k in keeps.items()}
+
+
+def prune_spec(net):
+    """Shapes of every conv/norm, stored with a pruned checkpoint."""
+    spec = {}
+    for name, m in net.named_modules():
+        name = name.replace('.module', '')
+        if isinstance(m, nn.Conv2d):
+            spec[name] = [m.out_channels, m.in_channels]
+        elif isinstance(m, nn.modules.batchnorm._NormBase):
+            spec[name] = [m.num_features]
+    return spec
+
+
+def apply_prune_spec(net, spec):
+    """Resize ``net`` to the shapes recorded by ``prune_spec`` before loading weights."""
+    for name, m in net.named_modules():
+        name = name.replace('.module', '')
+        if name not in spec:
+            continue
+        shape = spec[name]
+        if isinstance(m, nn.Conv2d):
+            out_mask = torch.arange(m.out_channels) < shape[0]
+            in_mask = torch.arange(m.in_channels) < shape[1]
+            _resize_module(m, out_mask, in_mask)
+        elif isinstance(m, nn.modules.batchnorm._NormBase):
+            _resize_module(m, torch.arange(m.num_features) < shape[0])
+
+
+def count_macs(net, input_size=64, device='cpu'):
+    """Multiply-accumulates of the convolutions for one image of ``input_size``."""
+    macs = [0]
+
+    def hook(m, inp, out):
+        k = m.kernel_size[0] * m.kernel_size[1]
+        macs[0] += out[0].numel() * (m.in_channels // m.groups) * k
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, nn.Conv2d)]
+    was_training = net.training
+    net.eval()
+    with torch.no_grad():
+        net(torch.rand(1, 3, input_size, input_size, device=device))
+    net.train(was_training)
+    for h in handles:
+        h.remove()
+    return macs[0]
+
+
+def search_ratio(net, target, criterion='bn', min_channels=4, scores=None, input_size=64, steps=12):
+    """Bisect the uniform prune ratio whose MACs reach ``target`` x the original."""
+    device = next(net.parameters()).device
+    base = count_macs(net, input_size, device)
+    if scores is None:
+        scores = {g.name: channel_importance(g, criterion) for g in build_groups(net)}
+    lo, hi = 0.0, 0.95
+    for _ in range(steps):
+        mid = (lo + hi) / 2
+        trial = copy.deepcopy(net)
+        prune_model(trial, mid, min_channels=min_channels, scores=scores)
+        if count_macs(trial, input_size, device) > target * base:
+            lo = mid
+        else:
+            hi = mid
+    return hi, scores
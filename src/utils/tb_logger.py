@@ -0,0 +1,63 @@
+"""TensorBoard logging from a background thread."""
+import queue
+import threading
+
+import torchvision
+from tensorboardX import SummaryWriter
+
+
+class AsyncSummaryWriter(object):
+    """SummaryWriter whose calls are queued and executed by a background thread.
+
+    add_scalar/add_image_grid/flush never block: when max_pending calls are already
+    waiting the new one is dropped and counted in .dropped. Image tensors may stay on
+    the GPU, the copy to host and make_grid run in the thread.
+    """
+    def __init__(self, logdir, max_pending=256):
+        self.writer = SummaryWriter(logdir)
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.dropped += 1
+
+    def add_scalar(self, tag, value, step):
+        self.put(('scalar', tag, value, step))
+
+    def add_image_grid(self, tag, images, nrow, step):
+        """Log a batch of (N, 3, H, W) images in [0, 1] as one grid of nrow columns."""
+        self.put(('grid', tag, images.detach(), nrow, step))
+
+    def flush(self):
+        self.put(('flush',))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                if job[0] == 'scalar':
+                    _, tag, value, step = job
+                    self.writer.add_scalar(tag, value, step)
+                elif job[0] == 'grid':
+                    _, tag, images, nrow, step = job
+                    grid = torchvision.utils.make_grid(images.float().cpu(), nrow=nrow)
+                    self.writer.add_image(tag, grid, step)
+                else:
+                    self.writer.flush()
+            except Exception as e:
+                print('==> TensorBoard logging error: %s' % e)
+
+    def close(self):
+        """Write everything still queued and close the event file."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            print('==> TensorBoard logger dropped %d entries (queue full)' % self.dropped)
+        self.writer.close()
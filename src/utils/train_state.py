@@ -0,0 +1,69 @@
+"""Helpers to checkpoint the complete training state and continue an interrupted epoch.
+
+A checkpoint's 'train_state' holds everything besides the weights: the optimizer and
+GradScaler states, the position in the epoch, the running meters and the RNG states.
+Everything is kept to tensors and python containers so torch.load(weights_only=True) reads it.
+"""
+import random
+import signal
+
+import numpy as np
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler (a single process by default) that can start an epoch part way through.
+
+    The order of an epoch depends only on seed and epoch, so skipping the samples this
+    rank already trained on yields exactly the rest of the interrupted epoch.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_start(self, start):
+        """Skip the first start samples of the next iteration (only that one)."""
+        self.start = start
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start:]
+        self.start = 0
+        return iter(indices)
+
+
+def get_rng_state():
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].copy()), np_state[2], np_state[3], np_state[4]),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached = state['numpy']
+    np.random.set_state((name, keys.numpy(), pos, has_gauss, cached))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class StopSignal(object):
+    """Turn SIGTERM (spot instance preemption) into a flag checked between iterations.
+
+    The training loop saves the full training state at the next check and returns, so
+    resuming from checkpoint.pth.tar continues at the following batch.
+    """
+    def __init__(self, signals=(signal.SIGTERM,)):
+        self.received = False
+        for sig in signals:
+            signal.signal(sig, self.handler)
+
+    def handler(self, signum, frame):
+        print('==> received signal %d, saving the training state at the next iteration' % signum)
+        self.received = True
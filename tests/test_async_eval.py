@@ -0,0 +1,72 @@
+import argparse
+import os
+import os.path as osp
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from options import Options
+import datasets
+import src.models as models
+
+NET_ARGS = ['--nets', 'slbr', '--models', 'slbr', '--mask_mode', 'res', '--k_center', '2', '--use_refine',
+            '--input-size', '64', '--crop_size', '64', '--preprocess', 'resize', '--workers', '0']
+
+
+def make_clwd(root, n_train=6, n_test=2, size=64):
+    """A tiny CLWD tree: random backgrounds with a blended square watermark."""
+    rng = np.random.RandomState(0)
+    for split, n in [('train', n_train), ('test', n_test)]:
+        for folder in ['Watermarked_image', 'Watermark_free_image', 'Mask', 'Alpha', 'Watermark']:
+            os.makedirs(osp.join(root, split, folder))
+        for i in range(n):
+            free = rng.randint(0, 256, (size, size, 3)).astype(np.uint8)
+            mark = np.zeros_like(free)
+            mark[8:40, 16:48] = rng.randint(0, 256, 3)
+            alpha = np.zeros((size, size), np.uint8)
+            alpha[8:40, 16:48] = 153
+            blend = alpha[..., None] / 255.
+            marked = (free * (1 - blend) + mark * blend).astype(np.uint8)
+            cv2.imwrite(osp.join(root, split, 'Watermarked_image', '%d.jpg' % i), marked)
+            cv2.imwrite(osp.join(root, split, 'Watermark_free_image', '%d.jpg' % i), free)
+            cv2.imwrite(osp.join(root, split, 'Mask', '%d.png' % i), (alpha > 0).astype(np.uint8) * 255)
+            cv2.imwrite(osp.join(root, split, 'Alpha', '%d.png' % i), alpha)
+            cv2.imwrite(osp.join(root, split, 'Watermark', '%d.png' % i), mark)
+
+
+def validate_in_process(argv):
+    args = Options().init(argparse.ArgumentParser()).parse_args(argv)
+    val_loader = torch.utils.data.DataLoader(datasets.CLWDDataset('val', args), batch_size=args.test_batch,
+                                             shuffle=False, num_workers=0)
+    machine = models.__dict__[args.models](datasets=(None, val_loader), args=args)
+    machine.validate(0)
+    machine.clean()
+    return machine.metric
+
+
+@pytest.mark.parametrize('extra', [[], ['--feat_cache', 'CACHE']], ids=['ema', 'ema-feat_cache'])
+def test_async_eval_matches_in_process(tmp_path, extra):
+    """The evaluator process scores a checkpoint like --evaluate does (EMA weights included)."""
+    data = str(tmp_path / 'clwd')
+    make_clwd(data)
+    extra = [str(tmp_path / 'cache') if a == 'CACHE' else a for a in extra]
+    argv = NET_ARGS + ['--dataset_dir', data, '--train-batch', '2', '--test-batch', '2', '--epochs', '1',
+                       '--checkpoint', str(tmp_path / 'ck'), '--name', 'async', '--ema', '0.5'] + extra
+    subprocess.run([sys.executable, 'train.py', '--async_eval', '--eval_gpu_id', '-1'] + argv,
+                   cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+    best_path = str(tmp_path / 'ck' / 'async' / 'model_best.pth.tar')
+    assert osp.exists(best_path), 'the evaluator validated no checkpoint'
+    async_metric = torch.load(best_path, map_location='cpu')['best_acc']
+
+    metric = validate_in_process(NET_ARGS + ['--dataset_dir', data, '--test-batch', '2', '--evaluate',
+                                             '--resume', best_path, '--checkpoint', str(tmp_path / 'eval'),
+                                             '--name', 'eval'])
+    assert async_metric == pytest.approx(metric, abs=1e-3)
@@ -1,12 +1,18 @@
 from __future__ import print_function, absolute_import
 
 import argparse
+import copy
 import torch,time,os
 
 torch.backends.cudnn.benchmark = True
 
-from src.utils.misc import save_checkpoint, adjust_learning_rate
+from src.utils.misc import save_checkpoint, adjust_learning_rate, parse_res_schedule, resolution_at
+from src.utils.distributed import init_distributed, cleanup_distributed, barrier, is_main_process
+from src.utils.train_state import ResumableSampler, StopSignal
+from src.utils.hard_sampler import HardExampleSampler
+from src.utils.batch_finder import lookup_batch, machine_key
 import src.models as models
+from src.models.AsyncEvaluator import AsyncEvaluator
 
 import datasets as datasets
 from options import Options
@@ -17,16 +23,19 @@ def main(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    args.dataset = args.dataset.lower()
-    if args.dataset == 'clwd':
-        dataset_func = datasets.CLWDDataset
-    elif args.dataset == 'lvw':
-        dataset_func = datasets.LVWDataset
-    else:
-        raise ValueError("Not known dataset:\t{}".format(args.dataset))
+    dataset_func = datasets.get_dataset(args)
 
-    train_loader = torch.utils.data.DataLoader(dataset_func('train',args),batch_size=args.train_batch, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
+    if args.auto_batch:
+        batch = lookup_batch(args, 'train', path=args.batch_config)
+        if batch is None:
+            raise ValueError('no batch stored for {} and these options, run find_batch.py with them first'.format(machine_key()))
+        print('==> --auto_batch: training batch %d' % batch)
+        args.train_batch = batch
+
+    train_args = train_loader_args(args)
+    schedule = parse_res_schedule(args.res_schedule)
+    train_size = resolution_at(schedule, args.start_epoch)
+    train_loader, train_sampler = build_train_loader(dataset_func, train_args, train_size)
     
     val_loader = torch.utils.data.DataLoader(dataset_func('val',args),batch_size=args.test_batch, shuffle=False,
         num_workers=args.workers, pin_memory=True)
@@ -34,29 +43,102 @@ def main(args):
     lr = args.lr
     data_loaders = (train_loader,val_loader)
 
+    # the evaluator copies args before the machine rewrites args.checkpoint
+    evaluator = AsyncEvaluator(args) if args.async_eval and args.rank == 0 else None
     model = models.__dict__[args.models](datasets=data_loaders, args=args)
+    model.evaluator = evaluator
+    # spot instance preemption: save the training state and stop at the next iteration
+    model.stop_signal = StopSignal()
     print('============================ Initization Finish && Training Start =============================================')
 
+    try:
+        train_epochs(model, data_loaders, train_sampler, lr, args,
+                     lambda size: build_train_loader(dataset_func, train_args, size), schedule, train_size)
+    finally:
+        # finish the pending checkpoint writes before the evaluator's last job
+        model.clean()
+        if evaluator is not None:
+            evaluator.close()
+
+
+def train_loader_args(args):
+    """The copy of args the train loader is (re)built from: the val dataset rewrites preprocess/no_flip of args."""
+    train_args = copy.copy(args)
+    if args.feat_cache != '':
+        # cached encoder features only match the images they were computed from: no augmentation
+        if args.res_schedule != '':
+            raise ValueError('--feat_cache trains at one resolution, it cannot be combined with --res_schedule')
+        train_args.preprocess, train_args.no_flip, train_args.batch_aug = 'resize', True, False
+    return train_args
+
+
+def build_train_loader(dataset_func, args, size=None):
+    """Training loader, at resolution size (if given) with the batch scaled to the same pixels per batch."""
+    if size is not None:
+        args = copy.copy(args)
+        base = args.crop_size if args.preprocess == 'resize_and_crop' else args.input_size
+        args.train_batch = max(1, int(round(args.train_batch * (base / size) ** 2)))
+        args.crop_size = args.input_size = size
+        print('==> training at %dx%d, batch %d' % (size, size, args.train_batch))
+    # rank 0 computes (and caches) the mask statistics, the other ranks then read them
+    if not is_main_process(args):
+        barrier(args)
+    train_set = dataset_func('train',args)
+    if is_main_process(args):
+        barrier(args)
+    # under torchrun every process reads its own shard; --train-batch is per process.
+    # The order of an epoch only depends on (seed, epoch), so an interrupted epoch can be continued
+    if args.hard_mining:
+        train_sampler = HardExampleSampler(train_set, num_replicas=args.world_size, rank=args.rank, seed=args.seed,
+                                           temperature=args.hard_temperature, decay=args.hard_decay)
+    else:
+        train_sampler = ResumableSampler(train_set, num_replicas=args.world_size, rank=args.rank, seed=args.seed)
+    train_loader = torch.utils.data.DataLoader(train_set,batch_size=args.train_batch,
+        sampler=train_sampler, num_workers=args.workers, pin_memory=True)
+    return train_loader, train_sampler
+
+
+def train_epochs(model, data_loaders, train_sampler, lr, args, build_loader=None, schedule=(), train_size=None):
     for epoch in range(model.args.start_epoch, model.args.epochs):
-        lr = adjust_learning_rate(data_loaders, model, epoch, lr, args)
+        size = resolution_at(schedule, epoch)
+        if size != train_size:
+            # next stage of the resolution curriculum (or resumed into one)
+            train_size = size
+            previous_sampler = train_sampler
+            train_loader, train_sampler = build_loader(size)
+            if hasattr(train_sampler, 'load_state_dict'):
+                # the hard example scores are per sample, whatever the resolution
+                train_sampler.load_state_dict(previous_sampler.state_dict())
+            model.train_loader = train_loader
+            data_loaders = (train_loader, data_loaders[1])
+        if model.train_state is not None and model.train_state['epoch'] == epoch and model.train_state['iteration'] > 0:
+            # continuing an epoch: the restored optimizers already carry its learning rate
+            lr = adjust_learning_rate(data_loaders, model, -1, lr, args)
+        else:
+            lr = adjust_learning_rate(data_loaders, model, epoch, lr, args)
         print('\nEpoch: %d | LR: %.8f' % (epoch + 1, lr))
+        train_sampler.set_epoch(epoch)
 
         model.record('lr',lr, epoch)        
         model.train(epoch)
+        if model.stopped:
+            break
         # model.validate(epoch)
         if args.freq < 0:
-            model.validate(epoch)
-            model.flush()
-            model.save_checkpoint()
+            if model.is_main:
+                model.validate_and_save(epoch)
+            barrier(args)
 
 if __name__ == '__main__':
     torch.backends.cudnn.benchmark = True
     parser=Options().init(argparse.ArgumentParser(description='WaterMark Removal'))
     args = parser.parse_args()
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+    if 'WORLD_SIZE' not in os.environ:
+        # torchrun processes pick their GPU by LOCAL_RANK, the launcher controls visibility
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
     print('==================================== WaterMark Removal =============================================')
     print('==> {:50}: {:<}'.format("Start Time",time.ctime(time.time())))
-    print('==> {:50}: {:<}'.format("USE GPU",os.environ['CUDA_VISIBLE_DEVICES']))
+    print('==> {:50}: {:<}'.format("USE GPU",os.environ.get('CUDA_VISIBLE_DEVICES', 'all')))
     print('==================================== Stable Parameters =============================================')
     for arg in vars(args):
         if type(getattr(args, arg)) == type([]):
@@ -74,5 +156,7 @@ if __name__ == '__main__':
             if getattr(args, arg) != parser.get_default(arg):
                 print('==> {:50}: {:<}({:<})'.format(arg,getattr(args, arg),parser.get_default(arg)))
     print('==================================== Start Init Model  ===============================================')
+    init_distributed(args)
     main(args)
+    cleanup_distributed(args)
     print('==================================== FINISH WITHOUT ERROR =============================================')
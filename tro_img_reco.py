@@ -188,6 +188,8 @@ def main():
     parser.add_argument("--cf_d1_account_id", required=False, help="Cloudflare D1 ACCOUNT_ID，可以通过环境变量传递")
     parser.add_argument("--cf_d1_database_id", required=False, help="Cloudflare D1 DATABASE_ID，可以通过环境变量传递")
     parser.add_argument("--skip_remove_wm", action="store_true", help="只进行分类，不进行去水印")
+    parser.add_argument("--wm_detect_threshold", required=False, type=float, default=None, help="先用 SLBR mask 分支检测水印，概率低于该阈值的图片不做去水印（如 0.5）")
+    parser.add_argument("--wm_auto_batch", action="store_true", help="去水印时按 find_batch.py 为本机测得的 batch 批量推理")
     args_cli = parser.parse_args()
 
     csv_path = os.path.abspath(args_cli.csv)
@@ -315,6 +317,12 @@ def main():
     if not args_cli.skip_remove_wm:
         parser=Options().init(argparse.ArgumentParser(description='WaterMark Removal'))
         args_list = ['--name','slbr_v1','--nets','slbr','--models','slbr','--input-size','512','--crop_size','512','--test-batch','1','--evaluate', '--preprocess','resize','--no_flip','--mask_mode','res','--k_center','2','--use_refine','--k_refine','3','--k_skip_stage','3','--resume',slbr_model_path,'--test_dir',download_dir]
+        if args_cli.wm_detect_threshold is not None:
+            # 水印检测作为廉价的前置过滤
+            args_list += ['--detect_threshold', str(args_cli.wm_detect_threshold)]
+        if args_cli.wm_auto_batch:
+            # 使用 find_batch.py --find_mode infer 为本机测得的 batch
+            args_list += ['--auto_batch']
         slbr_custom_args = parser.parse_args(args_list)
         print(slbr_custom_args)
         slbr_predict_custom(slbr_custom_args)